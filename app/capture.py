@@ -0,0 +1,107 @@
+import base64
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import time
+from typing import Optional
+
+# Запись выборки запросов, прошедших через LB, в JSONL (одна строка - один запрос) для app.replay.
+# На пути запроса только put в очередь; в файл пишет отдельный поток QueueListener, файл ротируется по размеру.
+
+LB_CAPTURE_SAMPLE = float(os.getenv("LB_CAPTURE_SAMPLE", "0"))  # доля запросов, 0 - выключено
+LB_CAPTURE_FILE = os.getenv("LB_CAPTURE_FILE", "traffic.jsonl")
+LB_CAPTURE_BODIES = os.getenv("LB_CAPTURE_BODIES", "1") == "1"  # иначе только sha256 и длина тела
+LB_CAPTURE_MAX_BYTES = int(os.getenv("LB_CAPTURE_MAX_BYTES", str(100 * 1024 * 1024)))
+LB_CAPTURE_BACKUPS = int(os.getenv("LB_CAPTURE_BACKUPS", "5"))
+
+
+class TrafficCapture:
+    def __init__(
+        self,
+        path: str = LB_CAPTURE_FILE,
+        sample: float = LB_CAPTURE_SAMPLE,
+        bodies: bool = LB_CAPTURE_BODIES,
+        max_bytes: int = LB_CAPTURE_MAX_BYTES,
+        backups: int = LB_CAPTURE_BACKUPS,
+    ):
+        self.path = path
+        self.sample = sample
+        self.bodies = bodies
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._queue: queue.Queue = queue.Queue(maxsize=10000)
+        self._logger = logging.getLogger("app.capture.traffic")
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        self._listener: Optional[logging.handlers.QueueListener] = None
+        self.dropped = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample > 0
+
+    def start(self):
+        if not self.enabled or self._listener is not None:
+            return
+        handler = logging.handlers.RotatingFileHandler(
+            self.path, maxBytes=self.max_bytes, backupCount=self.backups, encoding="utf-8"
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self._listener = logging.handlers.QueueListener(self._queue, handler)
+        self._listener.start()
+        self._logger.addHandler(_NonBlockingQueueHandler(self._queue, self))
+
+    def stop(self):
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+    def should_capture(self) -> bool:
+        return self.enabled and self._listener is not None and random.random() < self.sample
+
+    def record(
+        self,
+        method: str,
+        path: str,
+        query: str,
+        headers,
+        body: bytes,
+        status: int,
+        started: float,
+        upstream: Optional[str],
+    ):
+        entry = {
+            "ts": time.time(),
+            "method": method,
+            "path": path,
+            "query": query,
+            "content_type": headers.get("content-type"),
+            "body_sha256": hashlib.sha256(body).hexdigest() if body else None,
+            "body_len": len(body),
+            "status": status,
+            "duration_ms": round((time.perf_counter() - started) * 1000, 2),
+            "upstream": upstream,
+        }
+        if self.bodies and body:
+            try:
+                entry["body"] = body.decode("utf-8")
+            except UnicodeDecodeError:
+                entry["body_b64"] = base64.b64encode(body).decode("ascii")
+        self._logger.info(json.dumps(entry, ensure_ascii=False, separators=(",", ":")))
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    # если писатель не успевает, запись теряется, а запрос не ждёт
+    def __init__(self, q: queue.Queue, capture: TrafficCapture):
+        super().__init__(q)
+        self._capture = capture
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self._capture.dropped += 1
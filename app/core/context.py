@@ -0,0 +1,77 @@
+import contextvars
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+from app.core.errors import DeadlineExceeded
+
+
+# Контекст текущего запроса: транспорт создаёт его на входе,
+# сервис и хранилище читают через current().
+
+@dataclass
+class RequestContext:
+    deadline: Optional[float] = None  # time.monotonic()
+    cancelled: bool = False
+    # read-your-writes: LSN из прошлого ответа клиенту и LSN записи в этом запросе
+    min_lsn: Optional[str] = None
+    lsn: Optional[str] = None
+    # ключ идемпотентности записи: повтор с тем же ключом вернёт сохранённый результат
+    idempotency_key: Optional[str] = None
+    # трассировка: id приходит от LB (или создаётся транспортом), времена участков - в Server-Timing
+    trace_id: Optional[str] = None
+    started: float = field(default_factory=time.perf_counter)
+    timings: Dict[str, float] = field(default_factory=dict)
+
+    def remaining(self) -> Optional[float]:
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+    def expired(self) -> bool:
+        remaining = self.remaining()
+        return self.cancelled or (remaining is not None and remaining <= 0)
+
+    def check(self):
+        if self.cancelled:
+            raise DeadlineExceeded("request cancelled")
+        if self.expired():
+            raise DeadlineExceeded("deadline exceeded")
+
+    def cancel(self):
+        self.cancelled = True
+
+    def add_timing(self, name: str, seconds: float):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    @contextmanager
+    def span(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_timing(name, time.perf_counter() - t0)
+
+    def server_timing(self) -> str:
+        # "queue;dur=0.3, service;dur=4.1, db_pool;dur=0.2, db_sql;dur=3.5, total;dur=5.0"
+        timings = dict(self.timings)
+        timings["total"] = time.perf_counter() - self.started
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
+
+
+_current: contextvars.ContextVar = contextvars.ContextVar("request_context", default=None)
+
+
+def current() -> RequestContext:
+    ctx = _current.get()
+    return ctx if ctx is not None else RequestContext()
+
+
+@contextmanager
+def request_scope(ctx: RequestContext):
+    token = _current.set(ctx)
+    try:
+        yield ctx
+    finally:
+        _current.reset(token)
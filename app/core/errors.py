@@ -6,5 +6,25 @@ class ValidationError(Exception):
     pass
 
 
+class IdempotencyConflict(ValidationError):
+    pass
+
+
 class StorageUnavailable(Exception):
     pass
+
+
+class Overloaded(StorageUnavailable):
+    pass
+
+
+class DeadlineExceeded(StorageUnavailable):
+    pass
+
+
+class ChangeFeedDisabled(Exception):
+    pass
+
+
+class ResumeExpired(Exception):
+    pass
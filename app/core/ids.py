@@ -0,0 +1,34 @@
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Optional
+
+# id заметок - UUIDv7 (RFC 9562): старшие 48 бит - время создания в мс.
+# По id видно, в какую партицию notes (по created_at) смотреть, и новые id идут по возрастанию.
+
+
+def uuid7() -> uuid.UUID:
+    ms = time.time_ns() // 1_000_000
+    rand = int.from_bytes(os.urandom(10), "big")
+    value = (ms & 0xFFFF_FFFF_FFFF) << 80
+    value |= 0x7 << 76  # версия
+    value |= (rand >> 68) << 64  # rand_a, 12 бит
+    value |= 0b10 << 62  # вариант RFC
+    value |= rand & ((1 << 62) - 1)  # rand_b
+    return uuid.UUID(int=value)
+
+
+def new_id() -> str:
+    return str(uuid7())
+
+
+def id_time(note_id: str) -> Optional[datetime]:
+    # None -> id без времени (заметки, созданные до перехода на UUIDv7)
+    try:
+        value = uuid.UUID(note_id)
+    except ValueError:
+        return None
+    if value.version != 7:
+        return None
+    return datetime.fromtimestamp((value.int >> 80) / 1000, tz=timezone.utc)
@@ -0,0 +1,99 @@
+import asyncio
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from app.core.context import current
+from app.core.errors import NoteNotFound, Overloaded, ValidationError
+
+
+def max_limit_from_env(name: str, default: int) -> int:
+    return int(float(os.getenv(f"ADMISSION_{name.upper()}_MAX", str(default))))
+
+
+class AdaptiveLimiter:
+    # AIMD по латентности хранилища: пока вызовы укладываются в цель, лимит растёт
+    # примерно на 1 за окно из limit вызовов; медленный вызов или ошибка хранилища
+    # уменьшают лимит в backoff раз (не чаще раза за latency_target).
+    # Сверх лимита запрос сразу получает Overloaded, а не ждёт пул и statement_timeout.
+    def __init__(self, name: str, initial: float, min_limit: float, max_limit: float,
+                 latency_target: float, backoff: float = 0.9):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self._limit = float(initial)
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+        self.accepted = 0
+        self.rejected = 0
+
+    @classmethod
+    def from_env(cls, name: str, initial: int, max_limit: int) -> "AdaptiveLimiter":
+        prefix = f"ADMISSION_{name.upper()}"
+        return cls(
+            name,
+            initial=float(os.getenv(f"{prefix}_INITIAL", str(initial))),
+            min_limit=float(os.getenv(f"{prefix}_MIN", "1")),
+            max_limit=float(max_limit_from_env(name, max_limit)),
+            latency_target=float(os.getenv("ADMISSION_LATENCY_TARGET_MS", "250")) / 1000,
+        )
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @contextmanager
+    def slot(self):
+        with self._lock:
+            if self._in_flight >= int(self._limit):
+                self.rejected += 1
+                raise Overloaded(f"{self.name} capacity exceeded")
+            self._in_flight += 1
+            self.accepted += 1
+
+        started = time.monotonic()
+        ok = True
+        neutral = False
+        try:
+            yield
+        except (NoteNotFound, ValidationError):
+            raise
+        except (GeneratorExit, asyncio.CancelledError):
+            # клиент ушёл раньше, чем дочитал: о хранилище это ничего не говорит
+            neutral = True
+            raise
+        except BaseException:
+            # истёк дедлайн самого запроса (короткий бюджет клиента, statement_timeout по нему):
+            # о хранилище это тоже ничего не говорит, иначе один клиент с маленьким дедлайном
+            # сбивал бы общий лимит до min_limit
+            if current().expired():
+                neutral = True
+            else:
+                ok = False
+            raise
+        finally:
+            self._release(None if neutral else time.monotonic() - started, ok)
+
+    def _release(self, latency, ok: bool):
+        now = time.monotonic()
+        with self._lock:
+            self._in_flight -= 1
+            if ok and latency is None:
+                return
+            if ok and latency <= self.latency_target:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            elif now - self._last_decrease >= self.latency_target:
+                self._limit = max(self.min_limit, self._limit * self.backoff)
+                self._last_decrease = now
+
+    def stats(self):
+        return {
+            "limit": int(self._limit),
+            "in_flight": self._in_flight,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+        }
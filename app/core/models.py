@@ -1,13 +1,32 @@
 import uuid
 from datetime import datetime
 from dataclasses import dataclass, field
+from typing import Optional
 
 
 @dataclass
 class Note:
+    # при выборке части полей (fields) остальные - None
     id: str
-    description: str
-    created_at: datetime
-    updated_at: datetime
+    description: Optional[str] = None
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
 
 
+NOTE_FIELDS = ("id", "description", "created_at", "updated_at")
+
+
+@dataclass
+class Mutation:
+    op: str  # "create" | "update" | "delete"
+    note_id: Optional[str] = None
+    description: Optional[str] = None
+    idempotency_key: Optional[str] = None
+
+
+@dataclass
+class NoteChange:
+    seq: int
+    op: str  # "create" | "update" | "delete"
+    note_id: str
+    note: Optional[Note] = None  # None для delete
@@ -1,11 +1,70 @@
-from dataclasses import dataclass
+import asyncio
+import functools
+import itertools
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Iterable, List, Optional, Tuple
 
-from app.core.errors import NoteNotFound, ValidationError, StorageUnavailable
+from app.core.context import current
+from app.core.errors import (
+    ChangeFeedDisabled, DeadlineExceeded, NoteNotFound, ResumeExpired, ValidationError, StorageUnavailable,
+)
+from app.core.limiter import AdaptiveLimiter
+from app.core.models import NOTE_FIELDS, Mutation
+from app.core.singleflight import AsyncSingleFlight, SingleFlight
 from app.storage.base import Base
 
+if TYPE_CHECKING:
+    # changefeed тянет app.db (engine на импорте), сервису он нужен только как тип
+    from app.storage.changefeed import ChangeFeed
+
+
+# потолки лимитов чтений и записей по умолчанию (ADMISSION_READ_MAX / ADMISSION_WRITE_MAX)
+READ_LIMIT_MAX = 40
+WRITE_LIMIT_MAX = 20
+
+
+def parse_fields(fields: Optional[Iterable[str]]) -> Optional[Tuple[str, ...]]:
+    # None -> все поля; иначе запрошенные поля заметки (id - всегда) в порядке NOTE_FIELDS
+    if not fields:
+        return None
+    requested = set(fields)
+    unknown = requested.difference(NOTE_FIELDS)
+    if unknown:
+        raise ValidationError(f"unknown fields: {', '.join(sorted(unknown))}")
+    requested.add("id")
+    if len(requested) == len(NOTE_FIELDS):
+        return None
+    return tuple(f for f in NOTE_FIELDS if f in requested)
+
+
+def _traced(method):
+    # участок "service" в Server-Timing; "queue" - от входа запроса до сервиса (разбор, ожидание пула потоков)
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        ctx = current()
+        if "queue" not in ctx.timings:
+            ctx.add_timing("queue", time.perf_counter() - ctx.started)
+        with ctx.span("service"):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 @dataclass
 class NotesService:
     repo: Base
+    _reads: SingleFlight = field(default_factory=SingleFlight, init=False, repr=False)
+    _async_reads: AsyncSingleFlight = field(default_factory=AsyncSingleFlight, init=False, repr=False)
+    # номер поколения записей: чтение, начатое после записи, не присоединяется к более раннему
+    _write_counter: itertools.count = field(default_factory=itertools.count, init=False, repr=False)
+    _generation: int = field(default=0, init=False, repr=False)
+    # чтения и записи ограничиваются раздельно, чтобы поток чтений не вытеснял записи
+    read_limiter: AdaptiveLimiter = field(default_factory=lambda: AdaptiveLimiter.from_env("read", 10, READ_LIMIT_MAX))
+    write_limiter: AdaptiveLimiter = field(
+        default_factory=lambda: AdaptiveLimiter.from_env("write", 5, WRITE_LIMIT_MAX)
+    )
+    # лента изменений (WatchNotes / SSE); None - хранилище журнал не ведёт
+    changes: Optional["ChangeFeed"] = None
 
     def _normalize(self, description: str):
         description = description.strip()
@@ -15,38 +74,140 @@ class NotesService:
 
 
     def _wrap_storage_error(self, error: Exception):
+        if isinstance(error, StorageUnavailable):
+            raise error
+        if current().expired():
+            # statement_timeout / отмена из-за дедлайна запроса
+            raise DeadlineExceeded("deadline exceeded") from error
         raise StorageUnavailable("storage is unavailable") from error
 
+    def _wrote(self):
+        self._generation = next(self._write_counter) + 1
+
+    def stats(self):
+        return {
+            "reads": self._reads.stats(),
+            "async_reads": self._async_reads.stats(),
+            "read_limiter": self.read_limiter.stats(),
+            "write_limiter": self.write_limiter.stats(),
+            "changes": self.changes.stats() if self.changes is not None else None,
+        }
+
+    @_traced
     def create(self, description: str):
         description = self._normalize(description)
         try:
-            return self.repo.create(description)
+            current().check()
+            with self.write_limiter.slot():
+                return self.repo.create(description)
+        except (NoteNotFound, ValidationError):
+            # NoteNotFound: повтор по ключу идемпотентности, а созданную тогда заметку уже удалили
+            raise
         except Exception as e:
             self._wrap_storage_error(e)
+        finally:
+            self._wrote()
+
+
+    # Общий вызов идёт с дедлайном лидера. Если он истёк у лидера (короткий бюджет клиента,
+    # statement_timeout по нему, отмена), а у ждавшего время ещё есть, тот повторяет вызов сам.
+    def _coalesced(self, key, fn):
+        ctx = current()
+        ctx.check()
+        key = key + (self._generation, ctx.min_lsn)
+        while True:
+            try:
+                return self._reads.do(key, fn, timeout=ctx.remaining())
+            except TimeoutError:
+                raise DeadlineExceeded("deadline exceeded")
+            except DeadlineExceeded:
+                if ctx.expired():
+                    raise
 
+    async def _acoalesced(self, key, fn):
+        ctx = current()
+        ctx.check()
+        key = key + (self._generation, ctx.min_lsn)
+        while True:
+            try:
+                return await self._async_reads.do(key, fn, timeout=ctx.remaining())
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded("deadline exceeded")
+            except DeadlineExceeded:
+                if ctx.expired():
+                    raise
 
-    def get(self, note_id: str):
+    # fields: какие поля заметки нужны клиенту (см. parse_fields); хранилище читает только их,
+    # остальные поля в ответе - None. Чтения с разными fields не объединяются.
+    @_traced
+    def get(self, note_id: str, fields: Optional[Iterable[str]] = None):
+        fields = parse_fields(fields)
+        return self._coalesced(("get", note_id, fields), lambda: self._get(note_id, fields))
+
+    def _get(self, note_id: str, fields: Optional[Tuple[str, ...]] = None):
         try:
-            return self.repo.get(note_id)
+            current().check()
+            with self.read_limiter.slot():
+                return self.repo.get(note_id, fields=fields)
         except NoteNotFound:
             raise
         except Exception as e:
             self._wrap_storage_error(e)
 
-    def list(self):
+    @_traced
+    def list(self, fields: Optional[Iterable[str]] = None):
+        fields = parse_fields(fields)
+        return self._coalesced(("list", fields), lambda: self._list(fields))
+
+    def _list(self, fields: Optional[Tuple[str, ...]] = None):
         try:
-            return self.repo.list()
+            current().check()
+            with self.read_limiter.slot():
+                return self.repo.list(fields=fields)
         except Exception as e:
             self._wrap_storage_error(e)
 
+    async def aget(self, note_id: str, fields: Optional[Iterable[str]] = None):
+        fields = parse_fields(fields)
+        return await self._acoalesced(("get", note_id, fields), lambda: asyncio.to_thread(self.get, note_id, fields))
+
+    async def alist(self, fields: Optional[Iterable[str]] = None):
+        fields = parse_fields(fields)
+        return await self._acoalesced(("list", fields), lambda: asyncio.to_thread(self.list, fields))
+
+    def iter_list(self, fields: Optional[Iterable[str]] = None):
+        fields = parse_fields(fields)
+        notes = None
+        try:
+            current().check()
+            # слот - на открытие курсора и первую строку; дальше стрим идёт со скоростью клиента
+            # и лимит чтений не занимает
+            with self.read_limiter.slot():
+                notes = self.repo.iter_list(fields=fields)
+                first = next(notes, None)
+            if first is None:
+                return
+            yield first
+            yield from notes
+        except Exception as e:
+            self._wrap_storage_error(e)
+        finally:
+            if notes is not None:
+                notes.close()
+
+    @_traced
     def update(self, note_id: str, description: str):
         description = self._normalize(description)
         try:
-            return self.repo.update_description(note_id, description)
-        except NoteNotFound:
+            current().check()
+            with self.write_limiter.slot():
+                return self.repo.update_description(note_id, description)
+        except (NoteNotFound, ValidationError):
             raise
         except Exception as exc:
             self._wrap_storage_error(exc)
+        finally:
+            self._wrote()
 
 
     # def update_title(self, note_id: str, title: str) -> Note:
@@ -59,12 +220,71 @@ class NotesService:
     #         self._wrap_storage_error(exc)
 
 
+    @_traced
     def delete(self, note_id: str) -> None:
         try:
-            return self.repo.delete(note_id)
-        except NoteNotFound:
+            current().check()
+            with self.write_limiter.slot():
+                return self.repo.delete(note_id)
+        except (NoteNotFound, ValidationError):
             raise
         except Exception as exc:
             self._wrap_storage_error(exc)
+        finally:
+            self._wrote()
+
+    @_traced
+    def mutate(self, mutations: List[Mutation]) -> List:
+        # результат на каждую операцию: Note, None (удалено), NoteNotFound или ValidationError
+        results = [None] * len(mutations)
+        accepted = []
+        for i, m in enumerate(mutations):
+            try:
+                if m.op == "create":
+                    m = Mutation(op="create", description=self._normalize(m.description), idempotency_key=m.idempotency_key)
+                elif m.op == "update":
+                    m = Mutation(
+                        op="update",
+                        note_id=m.note_id,
+                        description=self._normalize(m.description),
+                        idempotency_key=m.idempotency_key,
+                    )
+                elif m.op != "delete":
+                    raise ValidationError(f"unknown operation {m.op!r}")
+            except ValidationError as e:
+                results[i] = e
+                continue
+            accepted.append((i, m))
+
+        if accepted:
+            try:
+                current().check()
+                with self.write_limiter.slot():
+                    applied = self.repo.apply_batch([m for _, m in accepted])
+            except Exception as e:
+                self._wrap_storage_error(e)
+            finally:
+                self._wrote()
+            for (i, _), result in zip(accepted, applied):
+                results[i] = result
+        return results
 
+    def subscribe(self, since: int = 0):
+        if self.changes is None:
+            raise ChangeFeedDisabled("change feed is disabled")
+        try:
+            return self.changes.subscribe(since)
+        except ResumeExpired:
+            raise
+        except Exception as e:
+            self._wrap_storage_error(e)
 
+    async def asubscribe(self, since: int = 0):
+        if self.changes is None:
+            raise ChangeFeedDisabled("change feed is disabled")
+        try:
+            return await self.changes.asubscribe(since)
+        except ResumeExpired:
+            raise
+        except Exception as e:
+            self._wrap_storage_error(e)
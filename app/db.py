@@ -1,13 +1,62 @@
 
 import os
+import time
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, DeclarativeBase
 
+from app.core.context import current
+from app.db_pool import monitor_for
+
 DATABASE_URL = os.getenv('DATABASE_URL')
+STATEMENT_TIMEOUT_MS = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', '1500'))
+# остаток дедлайна в пределах этого от STATEMENT_TIMEOUT_MS не выставляется отдельным set_config
+STATEMENT_TIMEOUT_SLACK_MS = int(os.getenv('DB_STATEMENT_TIMEOUT_SLACK_MS', '500'))
+
+# соединений на экземпляр приложения (к каждой БД), делятся между процессами uvicorn (WEB_CONCURRENCY):
+# 2/3 держатся в пуле постоянно, остальное - overflow под всплески
+DB_MAX_CONNECTIONS = int(os.getenv('DB_MAX_CONNECTIONS', '30'))
+WEB_CONCURRENCY = max(int(os.getenv('WEB_CONCURRENCY', '1')), 1)
+_PER_WORKER = max(DB_MAX_CONNECTIONS // WEB_CONCURRENCY, 2)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', str(_PER_WORKER * 2 // 3)))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', str(_PER_WORKER - _PER_WORKER * 2 // 3)))
+# соединения старше этого переоткрываются при выдаче (idle-таймауты pgbouncer / сетевых устройств)
+DB_POOL_RECYCLE_SEC = int(os.getenv('DB_POOL_RECYCLE_SEC', '1800'))
+
+# реплики только для чтения, через запятую
+DATABASE_REPLICA_URLS = [u for u in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if u]
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info["query_started"] = time.perf_counter()
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    # время SQL попадает в Server-Timing текущего запроса (db_sql)
+    current().add_timing("db_sql", time.perf_counter() - conn.info["query_started"])
+
+
+def make_engine(url: str):
+    # без pool_pre_ping: соединения проверяет фоновый PoolMonitor (db_pool.py), а не каждый запрос;
+    # разрыв между проверками закрывает повтор чтения в PostgresStorage
+    engine = create_engine(url, echo=False, future=True, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_recycle=DB_POOL_RECYCLE_SEC, pool_timeout=1, connect_args={'connect_timeout': 1, "options": f"-c statement_timeout={STATEMENT_TIMEOUT_MS}",}, )
+    event.listen(engine, "before_cursor_execute", _before_execute)
+    event.listen(engine, "after_cursor_execute", _after_execute)
+    monitor_for(engine)
+    return engine
+
+
+def make_sessionmaker(bind):
+    return sessionmaker(bind=bind, autoflush=False, autocommit=False, expire_on_commit=False)
+
+
+engine = make_engine(DATABASE_URL)
+SessionLocal = make_sessionmaker(engine)
 
-engine = create_engine(DATABASE_URL, echo=False, future=True, pool_pre_ping=True, pool_timeout=1, connect_args={'connect_timeout': 1, "options": "-c statement_timeout=1500",}, )
-SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, expire_on_commit=False)
+replica_engines = [make_engine(url) for url in DATABASE_REPLICA_URLS]
+# шарды: отдельные БД, заметки распределяются по хэшу id (см. storage/sharded.py)
+DATABASE_SHARD_URLS = [u for u in os.getenv('DATABASE_SHARD_URLS', '').split(',') if u]
+ReplicaSessions = [make_sessionmaker(e) for e in replica_engines]
 
 class BaseORM(DeclarativeBase):
     pass
@@ -1,27 +1,94 @@
 
 from datetime import datetime, timezone
-from uuid import uuid4
+from typing import Optional
 
-from sqlalchemy import String, Text, DateTime
+from sqlalchemy import BigInteger, DDL, LargeBinary, String, Text, DateTime, event
 from sqlalchemy.orm import Mapped, mapped_column
 
+from app.core.ids import new_id
 from app.db import BaseORM
 
 
 class NoteORM(BaseORM):
+    # партиционирована по created_at (см. storage/partitions.py), поэтому created_at входит в первичный ключ
     __tablename__ = "notes"
+    __table_args__ = {"postgresql_partition_by": "RANGE (created_at)"}
 
     id: Mapped[str] = mapped_column(
-        String, primary_key=True, default=lambda: str(uuid4())
+        String, primary_key=True, default=new_id
     )
     description: Mapped[str] = mapped_column(Text, nullable=False)
     created_at: Mapped[datetime] = mapped_column(
         DateTime(timezone=True),
+        primary_key=True,
         nullable=False,
         default=lambda: datetime.now(timezone.utc),
+        index=True,
     )
     updated_at: Mapped[datetime] = mapped_column(
         DateTime(timezone=True),
         nullable=False,
         default=lambda: datetime.now(timezone.utc),
     )
+
+
+class NoteChangeORM(BaseORM):
+    # журнал изменений для WatchNotes / SSE; чистится по CHANGE_FEED_RETENTION_SEC
+    __tablename__ = "note_changes"
+
+    seq: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    op: Mapped[str] = mapped_column(String(8), nullable=False)
+    note_id: Mapped[str] = mapped_column(String, nullable=False)
+    description: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    created_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    updated_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    changed_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        nullable=False,
+        default=lambda: datetime.now(timezone.utc),
+        index=True,
+    )
+
+
+# строки вне созданных партиций (импорт старых заметок, сбитые часы) попадают сюда, а не в ошибку вставки
+event.listen(
+    NoteORM.__table__,
+    "after_create",
+    DDL("CREATE TABLE IF NOT EXISTS notes_default PARTITION OF notes DEFAULT").execute_if(dialect="postgresql"),
+)
+
+
+CHANGES_CHANNEL = "note_changes"
+
+
+# NOTIFY шлёт сама БД на каждый INSERT в журнал, без лишнего запроса из приложения
+event.listen(
+    NoteChangeORM.__table__,
+    "after_create",
+    DDL(f"""
+        CREATE OR REPLACE FUNCTION notify_note_changes() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('{CHANGES_CHANNEL}', '');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        CREATE TRIGGER note_changes_notify AFTER INSERT ON note_changes
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_note_changes();
+    """).execute_if(dialect="postgresql"),
+)
+
+
+class IdempotencyKeyORM(BaseORM):
+    # результат записи по ключу идемпотентности; строки старше IDEMPOTENCY_TTL_SEC переиспользуются и чистятся
+    __tablename__ = "idempotency_keys"
+
+    # sha256 ключа: 32 байта вместо произвольной строки клиента
+    key: Mapped[bytes] = mapped_column(LargeBinary(32), primary_key=True)
+    op: Mapped[str] = mapped_column(String(8), nullable=False)
+    # sha256 операции и её аргументов: тот же ключ с другим запросом - конфликт, а не старый результат
+    request_hash: Mapped[bytes] = mapped_column(LargeBinary(32), nullable=False)
+    # результат - только ссылка на заметку (id, created_at для партиции) и её версия; сама заметка перечитывается
+    note_id: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    note_created_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    note_updated_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False, index=True)
@@ -0,0 +1,156 @@
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+
+# Вместо pool_pre_ping на каждой выдаче соединения: фоновый поток раз в DB_POOL_VALIDATE_SEC
+# проверяет простаивающие соединения пула (SELECT 1). Результат последней проверки - это и есть
+# живость БД для /health. Плюс счётчики пула для /stats.
+
+log = logging.getLogger(__name__)
+
+DB_POOL_VALIDATE_SEC = float(os.getenv("DB_POOL_VALIDATE_SEC", "10"))
+
+
+class PoolMonitor:
+    def __init__(self, engine: Engine, interval: float = DB_POOL_VALIDATE_SEC):
+        self._engine = engine
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.waiting = 0
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.connects = 0
+        self.connect_total = 0.0
+        self.connect_max = 0.0
+        self.invalidated = 0
+        self.alive: Optional[bool] = None  # None - ещё не проверяли
+        self.checked_at = 0.0
+        event.listen(engine, "do_connect", self._connect)
+        event.listen(engine, "invalidate", self._invalidate)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        # первая проверка сразу: /health не должен отвечать 503, пока поток не успел проснуться
+        self.validate()
+        self._thread = threading.Thread(target=self._run, name="db-pool-monitor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            self.validate()
+
+    def _connect(self, dialect, conn_rec, cargs, cparams):
+        # do_connect: соединяемся сами, чтобы замерить время установки соединения
+        started = time.perf_counter()
+        connection = dialect.connect(*cargs, **cparams)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.connects += 1
+            self.connect_total += elapsed
+            self.connect_max = max(self.connect_max, elapsed)
+        return connection
+
+    def _invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidated += 1
+
+    def acquire(self, session):
+        # checkout соединения для сессии; waiting - сколько запросов сейчас ждут пул
+        with self._lock:
+            self.waiting += 1
+        started = time.perf_counter()
+        try:
+            session.connection()
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.waiting -= 1
+                self.checkouts += 1
+                self.wait_total += elapsed
+                self.wait_max = max(self.wait_max, elapsed)
+
+    def _ping(self) -> bool:
+        try:
+            with self._engine.connect() as conn:
+                conn.exec_driver_sql("SELECT 1")
+            return True
+        except exc.TimeoutError:
+            # пул исчерпан (все соединения заняты запросами за pool_timeout): БД занята, а не лежит.
+            # Мёртвые соединения запросы сами выбросят из пула, и следующая проверка это увидит
+            return True
+        except Exception:
+            return False
+
+    def validate(self):
+        # QueuePool отдаёт простаивающие соединения по FIFO: checkedin() проверок обходят их все.
+        # Разорванное соединение пул выбрасывает сам (invalidate); тогда одна проверка на новом
+        # соединении решает, жива ли БД.
+        alive = False
+        for _ in range(max(self._engine.pool.checkedin(), 1)):
+            alive = self._ping()
+            if not alive:
+                alive = self._ping()
+                break
+        if not alive and self.alive is not False:
+            log.warning("database %s is not reachable", self.name)
+        self.alive = alive
+        self.checked_at = time.monotonic()
+
+    @property
+    def name(self) -> str:
+        url = self._engine.url
+        return f"{url.host}:{url.port or 5432}/{url.database}"
+
+    def healthy(self) -> bool:
+        # проверка давно не проходила (поток встал) - тоже нездоров
+        return bool(self.alive) and time.monotonic() - self.checked_at < 3 * self._interval
+
+    def stats(self):
+        pool = self._engine.pool
+        with self._lock:
+            return {
+                "size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "idle": pool.checkedin(),
+                "overflow": pool.overflow(),
+                "waiting": self.waiting,
+                "checkouts": self.checkouts,
+                "wait_ms_avg": round(self.wait_total / self.checkouts * 1000, 2) if self.checkouts else 0.0,
+                "wait_ms_max": round(self.wait_max * 1000, 2),
+                "connects": self.connects,
+                "connect_ms_avg": round(self.connect_total / self.connects * 1000, 2) if self.connects else 0.0,
+                "connect_ms_max": round(self.connect_max * 1000, 2),
+                "invalidated": self.invalidated,
+                "alive": self.alive,
+                "checked_sec_ago": round(time.monotonic() - self.checked_at, 1) if self.checked_at else None,
+            }
+
+
+_lock = threading.Lock()
+# движки живут всё время процесса, монитор на каждый (primary, реплики, шарды)
+_monitors: Dict[Engine, PoolMonitor] = {}
+
+
+def monitor_for(engine: Engine) -> PoolMonitor:
+    with _lock:
+        monitor = _monitors.get(engine)
+        if monitor is None:
+            monitor = _monitors[engine] = PoolMonitor(engine)
+        return monitor
+
+
+def monitors() -> List[PoolMonitor]:
+    with _lock:
+        return list(_monitors.values())
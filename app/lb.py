@@ -3,9 +3,13 @@ import os
 import time
 from dataclasses import dataclass
 from typing import Dict, List, Optional
+from uuid import uuid4
 
 import httpx
 from fastapi import FastAPI, Request, Response
+from fastapi.responses import StreamingResponse
+
+from app.capture import TrafficCapture
 
 HOP_BY_HOP = {
     "connection",
@@ -59,6 +63,35 @@ class CircuitBreakerLB:
                 s.down_until = time.monotonic() + self.cooldown_sec
 
 
+def _request_budget(request: Request) -> float:
+    raw = request.headers.get(DEADLINE_HEADER)
+    if raw:
+        try:
+            return min(REQUEST_BUDGET, float(raw) / 1000)
+        except ValueError:
+            pass
+    return REQUEST_BUDGET
+
+
+def _attempt_timeout(remaining: float) -> httpx.Timeout:
+    return httpx.Timeout(
+        connect=min(CONNECT_TIMEOUT, remaining),
+        read=min(READ_TIMEOUT, remaining),
+        write=min(READ_TIMEOUT, remaining),
+        pool=min(CONNECT_TIMEOUT, remaining),
+    )
+
+
+def _timing_headers(trace_id: str, started: float, retry_sec: float, upstream_sec: float, upstream_timing: str = ""):
+    # к разбивке апстрима добавляем свои участки: неудачные попытки, последняя попытка и весь запрос в LB
+    total = time.perf_counter() - started
+    own = f"lb_retry;dur={retry_sec * 1000:.1f}, lb_upstream;dur={upstream_sec * 1000:.1f}, lb;dur={total * 1000:.1f}"
+    return {
+        TRACE_HEADER: trace_id,
+        SERVER_TIMING_HEADER: f"{upstream_timing}, {own}" if upstream_timing else own,
+    }
+
+
 def _filter_headers(headers) -> Dict[str, str]:
     out = {}
     for k, v in headers.items():
@@ -81,19 +114,39 @@ CONNECT_TIMEOUT = float(os.getenv("LB_CONNECT_TIMEOUT", "0.3"))
 READ_TIMEOUT = float(os.getenv("LB_READ_TIMEOUT", "1.5"))
 
 RETRIES = int(os.getenv("LB_RETRIES", "2"))
+# бюджет на весь запрос со всеми повторами; меньший бюджет может прийти от клиента в заголовке
+REQUEST_BUDGET = float(os.getenv("LB_REQUEST_BUDGET", "2"))
+DEADLINE_HEADER = "x-request-deadline-ms"
+IDEMPOTENCY_HEADER = "idempotency-key"
+TRACE_HEADER = "x-trace-id"
+SERVER_TIMING_HEADER = "server-timing"
+SAFE_METHODS = {"GET", "HEAD", "OPTIONS"}
+# долгоживущие ответы (SSE), которые проксируются потоком
+STREAM_PATHS = {p.strip("/") for p in os.getenv("LB_STREAM_PATHS", "/notes/changes").split(",") if p}
+# поток держит соединение с апстримом всё время подписки: сверх лимита - 503 с Retry-After
+STREAM_MAX = int(os.getenv("LB_STREAM_MAX", "1000"))
 
 app = FastAPI()
 lb = CircuitBreakerLB(UPSTREAMS, FAIL_THRESHOLD, COOLDOWN_SEC)
+capture = TrafficCapture()
 
 client = httpx.AsyncClient(
     timeout=httpx.Timeout(connect=CONNECT_TIMEOUT, read=READ_TIMEOUT, write=READ_TIMEOUT, pool=CONNECT_TIMEOUT),
     limits=httpx.Limits(max_keepalive_connections=50, max_connections=200),
 )
+# у потоков свой пул: подписчики не должны занимать соединения обычных запросов и health_loop
+stream_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(connect=CONNECT_TIMEOUT, read=None, write=READ_TIMEOUT, pool=CONNECT_TIMEOUT),
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=STREAM_MAX),
+)
+_streams = 0
 
 
 @app.on_event("shutdown")
 async def _shutdown():
     await client.aclose()
+    await stream_client.aclose()
+    capture.stop()
 
 
 async def health_loop():
@@ -105,6 +158,9 @@ async def health_loop():
                     await lb.mark_success(s)
                 else:
                     await lb.mark_failure(s)
+            except httpx.PoolTimeout:
+                # свободного соединения не дождались - это нагрузка на самом LB, а не отказ апстрима
+                pass
             except Exception:
                 await lb.mark_failure(s)
         await asyncio.sleep(CHECK_INTERVAL)
@@ -112,50 +168,184 @@ async def health_loop():
 
 @app.on_event("startup")
 async def _startup():
+    capture.start()
     asyncio.create_task(health_loop())
 
 
+def _is_event_stream(path: str, request: Request) -> bool:
+    # curl и EventSource без заголовка Accept тоже должны попасть в поток, а не под бюджет запроса
+    if request.method != "GET":
+        return False
+    return path.strip("/") in STREAM_PATHS or "text/event-stream" in request.headers.get("accept", "")
+
+
+async def _proxy_stream(path: str, suffix: str, headers: Dict[str, str]) -> Response:
+    # SSE: ответ отдаётся по мере поступления, без таймаута чтения и без бюджета запроса.
+    # Долгие потоки не влияют на circuit breaker: живость экземпляров определяет health_loop
+    global _streams
+    if _streams >= STREAM_MAX:
+        return Response(content="too many streams", status_code=503, headers={"Retry-After": "1"})
+    _streams += 1
+    try:
+        response = await _open_stream(path, suffix, headers)
+    except BaseException:
+        _streams -= 1
+        raise
+    if not isinstance(response, _UpstreamStream):
+        _streams -= 1
+    return response
+
+
+class _UpstreamStream(StreamingResponse):
+    # при обрыве клиента Starlette не вызывает background: соединение с апстримом
+    # и место в STREAM_MAX освобождаются здесь в любом случае
+    def __init__(self, upstream_response: httpx.Response, **kwargs):
+        super().__init__(upstream_response.aiter_raw(), **kwargs)
+        self._upstream_response = upstream_response
+
+    async def __call__(self, scope, receive, send):
+        global _streams
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            _streams -= 1
+            await self._upstream_response.aclose()
+
+
+async def _open_stream(path: str, suffix: str, headers: Dict[str, str]) -> Response:
+    last_err = None
+    for _ in range(RETRIES):
+        upstream = await lb.pick()
+        if upstream is None:
+            return Response(content="no healthy upstreams", status_code=503)
+
+        request = stream_client.build_request("GET", f"{upstream.url}/{path}{suffix}", headers=headers)
+        try:
+            r = await stream_client.send(request, stream=True)
+        except (httpx.TimeoutException, httpx.RequestError) as e:
+            last_err = f"{type(e).__name__}: {e}"
+            continue
+
+        if 500 <= r.status_code <= 599:
+            await r.aclose()
+            last_err = f"upstream {upstream.url} returned {r.status_code}"
+            continue
+
+        resp_headers = _filter_headers(r.headers)
+        resp_headers["X-LB-Upstream"] = upstream.url
+        return _UpstreamStream(r, status_code=r.status_code, headers=resp_headers)
+
+    return Response(content=f"upstream failure: {last_err}", status_code=503)
+
+
 @app.api_route("/{path:path}", methods=ALL_METHODS)
 async def proxy(path: str, request: Request):
+    started = time.perf_counter()
     body = await request.body()
+    response = await _proxy(path, request, body)
+    if capture.should_capture():
+        capture.record(
+            request.method,
+            "/" + path,
+            str(request.url.query),
+            request.headers,
+            body,
+            response.status_code,
+            started,
+            response.headers.get("X-LB-Upstream"),
+        )
+    return response
+
+
+async def _proxy(path: str, request: Request, body: bytes) -> Response:
     headers = _filter_headers(request.headers)
 
+    # без этого httpx подставит свой Accept-Encoding, и апстрим сожмёт ответ для клиента, который этого не просил
+    headers.setdefault("accept-encoding", "identity")
+
     query = str(request.url.query)
     suffix = f"?{query}" if query else ""
     method = request.method
 
+    if _is_event_stream(path, request):
+        return await _proxy_stream(path, suffix, headers)
+    if method not in SAFE_METHODS and IDEMPOTENCY_HEADER not in headers:
+        # один ключ на все попытки: повтор записи после таймаута вернёт тот же результат, а не дубликат
+        headers[IDEMPOTENCY_HEADER] = str(uuid4())
+    trace_id = headers.setdefault(TRACE_HEADER, uuid4().hex)
+
     last_err = None
+    deadline = time.monotonic() + _request_budget(request)
+    started = time.perf_counter()
+    retry_sec = 0.0
 
     for _ in range(RETRIES):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return Response(
+                content=f"deadline exceeded: {last_err}",
+                status_code=504,
+                headers=_timing_headers(trace_id, started, retry_sec, 0.0),
+            )
+
         upstream = await lb.pick()
         if upstream is None:
             return Response(content="no healthy upstreams", status_code=503)
 
         url = f"{upstream.url}/{path}{suffix}"
+        # апстрим не должен работать дольше, чем LB ждёт эту попытку
+        timeout = _attempt_timeout(remaining)
+        headers[DEADLINE_HEADER] = str(int(timeout.read * 1000))
+        # попытку укоротил бюджет запроса (в т.ч. клиентский): её таймаут - не признак медленного апстрима
+        shortened = timeout.read < READ_TIMEOUT
 
+        attempt_started = time.perf_counter()
         try:
-            r = await client.request(
-                method,
-                url,
-                content=body,
-                headers=headers,
-                follow_redirects=False,
+            r = await client.send(
+                client.build_request(method, url, content=body, headers=headers, timeout=timeout),
+                stream=True,
             )
+            try:
+                # тело как есть, без распаковки: сжатый ответ апстрима уходит клиенту сжатым
+                content = b"".join([chunk async for chunk in r.aiter_raw()])
+            finally:
+                await r.aclose()
+            upstream_sec = time.perf_counter() - attempt_started
+
+            if r.status_code == 503 and "retry-after" in r.headers:
+                # экземпляр сбрасывает нагрузку, но жив: пробуем другой, breaker не трогаем
+                last_err = f"upstream {upstream.url} is overloaded"
+                retry_sec += upstream_sec
+                continue
 
-            if 500 <= r.status_code <= 599:
+            # 504 на укороченной попытке: апстрим не уложился в урезанный дедлайн, а не отказал -
+            # breaker не трогаем и отдаём ответ как есть, повторять уже некогда
+            deadline_hit = r.status_code == 504 and shortened
+            if 500 <= r.status_code <= 599 and not deadline_hit:
                 await lb.mark_failure(upstream)
                 last_err = f"upstream {upstream.url} returned {r.status_code}"
+                retry_sec += upstream_sec
                 continue
-
-            await lb.mark_success(upstream)
+            if not deadline_hit:
+                await lb.mark_success(upstream)
 
             resp_headers = _filter_headers(r.headers)
             resp_headers["X-LB-Upstream"] = upstream.url
+            resp_headers.update(
+                _timing_headers(trace_id, started, retry_sec, upstream_sec, r.headers.get(SERVER_TIMING_HEADER, ""))
+            )
 
-            return Response(content=r.content, status_code=r.status_code, headers=resp_headers)
+            return Response(content=content, status_code=r.status_code, headers=resp_headers)
 
         except (httpx.TimeoutException, httpx.RequestError) as e:
-            await lb.mark_failure(upstream)
+            # PoolTimeout - не дождались соединения в пуле самого LB, апстрим тут ни при чём
+            if not isinstance(e, httpx.PoolTimeout) and not (shortened and isinstance(e, httpx.ReadTimeout)):
+                await lb.mark_failure(upstream)
             last_err = f"{type(e).__name__}: {e}"
+            retry_sec += time.perf_counter() - attempt_started
 
-    return Response(content=f"upstream failure: {last_err}", status_code=503)
+    return Response(
+        content=f"upstream failure: {last_err}",
+        status_code=503,
+        headers=_timing_headers(trace_id, started, retry_sec, 0.0),
+    )
@@ -1,12 +1,61 @@
-from app.core.service import NotesService
-from app.storage.postgres import PostgresStorage
-from app.db import BaseORM, engine
+import logging
+import os
+
+from app.core.limiter import max_limit_from_env
+from app.core.service import READ_LIMIT_MAX, WRITE_LIMIT_MAX, NotesService
+from app.storage.changefeed import ChangeFeed
+from app.storage.partitions import PartitionManager
+from app.storage.postgres import PostgresStorage, prune_idempotency_keys
+from app.storage.sharded import ShardedStorage
+from app.db import BaseORM, engine, ReplicaSessions, DATABASE_SHARD_URLS, make_engine, make_sessionmaker
 from app.db_models import NoteORM
 
 
-BaseORM.metadata.create_all(bind=engine)
+log = logging.getLogger(__name__)
+
+# партиции на ближайшие интервалы создаются до первого запроса, дальше - фоновой проверкой (rest.py),
+# она же чистит истёкшие ключи идемпотентности
+partitions = []
+
+
+def _prepare(bind):
+    BaseORM.metadata.create_all(bind=bind)
+    manager = PartitionManager(bind, jobs=[prune_idempotency_keys])
+    try:
+        manager.ensure()
+    except Exception:
+        # lock_timeout из-за другой копии или временная ошибка DDL не должны ронять запуск:
+        # до следующей фоновой проверки новые строки лягут в notes_default, оттуда их перенесёт ensure
+        log.exception("notes partition maintenance at startup failed")
+    partitions.append(manager)
+
+
+def _build_sharded_storage() -> ShardedStorage:
+    shards = {}
+    for i, url in enumerate(DATABASE_SHARD_URLS):
+        shard_engine = make_engine(url)
+        _prepare(shard_engine)
+        shards[f"shard{i}"] = PostgresStorage(session_factory=make_sessionmaker(shard_engine))
+
+    # после добавления шардов в конец списка: SHARD_REBALANCE_FROM = прежнее число шардов.
+    # Экземпляры только ищут заметки и у прежнего владельца, переносит их отдельная команда app.rebalance
+    rebalance_from = int(os.getenv("SHARD_REBALANCE_FROM", "0"))
+    previous = [f"shard{i}" for i in range(rebalance_from)] if 0 < rebalance_from < len(shards) else None
+    # каждый пропущенный лимитами запрос может одновременно пойти во все шарды
+    in_flight = max_limit_from_env("read", READ_LIMIT_MAX) + max_limit_from_env("write", WRITE_LIMIT_MAX)
+    return ShardedStorage(shards, previous=previous, workers=in_flight * len(shards))
+
 
-storage = PostgresStorage()
+# лента изменений пока только для одной БД: у шардов свои журналы и свои seq
+changes = None
+if DATABASE_SHARD_URLS:
+    storage = _build_sharded_storage()
+else:
+    _prepare(engine)
+    change_log = os.getenv("CHANGE_FEED", "1") == "1"
+    storage = PostgresStorage(replica_factories=ReplicaSessions, change_log=change_log)
+    if change_log:
+        changes = ChangeFeed()
 
 if __name__ == "__main__":
     NotesService(storage)
@@ -0,0 +1,52 @@
+import collections
+import sys
+import threading
+import time
+from typing import Counter
+
+# Статистический профайлер: раз в interval снимает стеки всех потоков (sys._current_frames)
+# и отдаёт их в collapsed-формате ("поток;f1;f2;f3 N"), который понимают flamegraph.pl и speedscope.
+
+MAX_SECONDS = 60.0
+
+_running = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+
+
+def sample(seconds: float, interval: float = 0.005) -> Counter:
+    if not _running.acquire(blocking=False):
+        raise ProfilerBusy("profiler is already running")
+    try:
+        seconds = min(max(seconds, 0.0), MAX_SECONDS)
+        me = threading.get_ident()
+        names = {}
+        stacks: Counter = collections.Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks[";".join(reversed(stack))] += 1
+            time.sleep(interval)
+        return stacks
+    finally:
+        _running.release()
+
+
+def collapsed(stacks: Counter) -> str:
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
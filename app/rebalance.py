@@ -0,0 +1,27 @@
+import argparse
+import logging
+import sys
+
+# Перенос заметок к новым владельцам после добавления шардов (см. «Шардирование» в readme):
+# DATABASE_SHARD_URLS=<все шарды> python -m app.rebalance
+# Запускается один раз, отдельно от экземпляров приложения. Перенос идемпотентен: повторный запуск
+# (или запуск после сбоя) переносит только то, что осталось на старых местах.
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.rebalance", description="move notes to their shards")
+    parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    # хранилище собирается из того же окружения, что и у экземпляров приложения
+    from app.main import storage
+    from app.storage.sharded import ShardedStorage
+
+    if not isinstance(storage, ShardedStorage):
+        sys.exit("DATABASE_SHARD_URLS is not set, nothing to rebalance")
+    moved = storage.rebalance()
+    print(f"moved {moved} notes, SHARD_REBALANCE_FROM can be removed from the application environment")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import argparse
+import asyncio
+import base64
+import collections
+import json
+import math
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+# Нагрузочный прогон по записанному LB трафику (app.capture):
+# python -m app.replay traffic.jsonl --target https://localhost --speed 2 --concurrency 50
+# Интервалы между запросами сохраняются (делятся на speed, speed=0 - без пауз), в полёте не больше concurrency.
+
+
+def load(paths: List[str], limit: Optional[int] = None) -> List[dict]:
+    # можно передать и ротированные части (traffic.jsonl.1 ...), записи упорядочиваются по времени
+    entries = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    entries.append(json.loads(line))
+    entries.sort(key=lambda e: e["ts"])
+    return entries[:limit]
+
+
+def _body(entry: dict) -> Optional[bytes]:
+    # None -> тело было, но не записано (LB_CAPTURE_BODIES=0), повторить такой запрос нельзя
+    if "body" in entry:
+        return entry["body"].encode("utf-8")
+    if "body_b64" in entry:
+        return base64.b64decode(entry["body_b64"])
+    if entry.get("body_len"):
+        return None
+    return b""
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    # nearest-rank
+    i = max(0, math.ceil(p / 100 * len(sorted_values)) - 1)
+    return sorted_values[i]
+
+
+class Stats:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.statuses: Dict[str, int] = collections.Counter()
+        self.skipped = 0
+
+    def report(self, elapsed: float) -> str:
+        latencies = sorted(self.latencies)
+        sent = len(latencies)
+        lines = [
+            f"requests: {sent}, skipped: {self.skipped}, elapsed: {elapsed:.2f}s, "
+            f"throughput: {sent / elapsed if elapsed > 0 else 0.0:.1f} req/s",
+            "latency ms: "
+            + ", ".join(f"p{p}={percentile(latencies, p) * 1000:.1f}" for p in (50, 90, 99))
+            + f", max={(latencies[-1] if latencies else 0.0) * 1000:.1f}",
+            "status: " + ", ".join(f"{k}={v}" for k, v in sorted(self.statuses.items())),
+        ]
+        return "\n".join(lines)
+
+
+async def _send(client: httpx.AsyncClient, entry: dict, body: bytes, stats: Stats, sem: asyncio.Semaphore):
+    url = entry["path"] + (f"?{entry['query']}" if entry.get("query") else "")
+    headers = {"content-type": entry["content_type"]} if entry.get("content_type") else {}
+    started = time.perf_counter()
+    try:
+        r = await client.request(entry["method"], url, content=body, headers=headers)
+        stats.statuses[str(r.status_code)] += 1
+    except httpx.HTTPError as e:
+        stats.statuses[type(e).__name__] += 1
+    finally:
+        stats.latencies.append(time.perf_counter() - started)
+        sem.release()
+
+
+async def replay(
+    entries: List[dict],
+    target: str,
+    speed: float = 1.0,
+    concurrency: int = 10,
+    timeout: float = 10.0,
+    verify: bool = True,
+) -> Stats:
+    stats = Stats()
+    sem = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=target, timeout=timeout, limits=limits, verify=verify) as client:
+        tasks = []
+        first_ts = entries[0]["ts"] if entries else 0.0
+        started = time.monotonic()
+        for entry in entries:
+            body = _body(entry)
+            if body is None:
+                stats.skipped += 1
+                continue
+            if speed > 0:
+                delay = (entry["ts"] - first_ts) / speed - (time.monotonic() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            # если все слоты заняты, запрос ждёт и отстаёт от исходного расписания
+            await sem.acquire()
+            tasks.append(asyncio.create_task(_send(client, entry, body, stats, sem)))
+        await asyncio.gather(*tasks)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.replay", description="replay captured LB traffic")
+    parser.add_argument("files", nargs="+", help="JSONL written by the LB (LB_CAPTURE_FILE)")
+    parser.add_argument("--target", default="http://localhost:8080")
+    parser.add_argument("--speed", type=float, default=1.0, help="time scale, 0 = as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--limit", type=int, default=None, help="replay only the first N records")
+    parser.add_argument("--timeout", type=float, default=10.0)
+    parser.add_argument("--insecure", action="store_true", help="do not verify TLS certificates")
+    args = parser.parse_args(argv)
+
+    entries = load(args.files, args.limit)
+    started = time.monotonic()
+    stats = asyncio.run(
+        replay(entries, args.target, args.speed, args.concurrency, args.timeout, verify=not args.insecure)
+    )
+    print(stats.report(time.monotonic() - started))
+
+
+if __name__ == "__main__":
+    main()
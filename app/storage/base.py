@@ -1,6 +1,8 @@
 import abc
+from typing import Iterator, List, Optional, Sequence
 
-from app.core.models import Note
+from app.core.errors import NoteNotFound
+from app.core.models import Mutation, Note
 
 
 class Base(abc.ABC):
@@ -8,8 +10,9 @@ class Base(abc.ABC):
     def create(self, description: str) -> Note:
         pass
 
+    # fields: None - все поля, иначе хранилище может читать только их (остальные в Note - None)
     @abc.abstractmethod
-    def get(self,note_id: str) -> Note:
+    def get(self,note_id: str, fields: Optional[Sequence[str]] = None) -> Note:
         pass
     # @abc.abstractmethod
     # def list(self):
@@ -18,8 +21,11 @@ class Base(abc.ABC):
     def update_description(self, note_id: str, description: str) -> Note:
         pass
     @abc.abstractmethod
-    def list(self) -> list[Note]:
+    def list(self, limit: Optional[int] = None, offset: int = 0, fields: Optional[Sequence[str]] = None) -> list[Note]:
         pass
+
+    def iter_list(self, fields: Optional[Sequence[str]] = None) -> Iterator[Note]:
+        yield from self.list(fields=fields)
     # def update_title(self, note_id: str, title: str):
     #     pass
 
@@ -27,3 +33,18 @@ class Base(abc.ABC):
     def delete(self, note_id: str) -> None:
         pass
 
+    def apply_batch(self, mutations: List[Mutation]) -> List:
+        # на каждую операцию: Note, None (удалено) или NoteNotFound
+        results = []
+        for m in mutations:
+            try:
+                if m.op == "create":
+                    results.append(self.create(m.description))
+                elif m.op == "update":
+                    results.append(self.update_description(m.note_id, m.description))
+                else:
+                    self.delete(m.note_id)
+                    results.append(None)
+            except NoteNotFound as e:
+                results.append(e)
+        return results
@@ -0,0 +1,286 @@
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+import psycopg
+from sqlalchemy import delete, func, select
+from sqlalchemy.orm import sessionmaker
+
+from app.core.errors import ResumeExpired
+from app.core.models import Note, NoteChange
+from app.db import SessionLocal
+from app.db_models import CHANGES_CHANNEL, NoteChangeORM
+
+# Лента изменений: один поток на экземпляр слушает LISTEN note_changes,
+# дочитывает новые строки журнала и раздаёт их всем подписчикам.
+
+log = logging.getLogger(__name__)
+
+CHANGE_FEED_RETENTION_SEC = float(os.getenv("CHANGE_FEED_RETENTION_SEC", "86400"))
+CHANGE_FEED_QUEUE_SIZE = int(os.getenv("CHANGE_FEED_QUEUE_SIZE", "1000"))
+
+READ_BATCH = 500
+
+
+def _to_change(row: NoteChangeORM) -> NoteChange:
+    note = None
+    if row.op != "delete":
+        note = Note(id=row.note_id, description=row.description, created_at=row.created_at, updated_at=row.updated_at)
+    return NoteChange(seq=row.seq, op=row.op, note_id=row.note_id, note=note)
+
+
+class Subscription:
+    # очередь подписчика ограничена: при переполнении он отстаёт и дочитывает из журнала
+    def __init__(self, feed: "ChangeFeed", since: int, maxsize: int):
+        self._feed = feed
+        self._queue: queue.Queue = queue.Queue(maxsize)
+        self.last_seq = since
+        self._behind = True
+
+    def _push(self, changes: List[NoteChange]):
+        # вызывается потоком ленты под feed._lock
+        if self._behind:
+            return
+        for change in changes:
+            try:
+                self._queue.put_nowait(change)
+            except (queue.Full, asyncio.QueueFull):
+                self._behind = True
+                return
+
+    def _fresh(self, changes: List[NoteChange]) -> List[NoteChange]:
+        # одно изменение может прийти и из журнала, и из очереди
+        fresh = [c for c in changes if c.seq > self.last_seq]
+        if fresh:
+            self.last_seq = fresh[-1].seq
+        return fresh
+
+    def _start_catch_up(self) -> bool:
+        with self._feed._lock:
+            if not self._behind:
+                return False
+            self._behind = False
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            return True
+
+    def _catch_up_done(self, changes: List[NoteChange]):
+        if len(changes) == READ_BATCH:
+            with self._feed._lock:
+                self._behind = True
+
+    def next(self, timeout: Optional[float] = None) -> List[NoteChange]:
+        # пустой список -> за timeout ничего не пришло
+        if self._start_catch_up():
+            changes = self._feed.read_since(self.last_seq)
+            self._catch_up_done(changes)
+            if changes:
+                return self._fresh(changes)
+        try:
+            changes = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                changes.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return self._fresh(changes)
+
+    def close(self):
+        self._feed._unsubscribe(self)
+
+
+class AsyncSubscription(Subscription):
+    # то же для asyncio: поток ленты передаёт изменения в event loop подписчика
+    def __init__(self, feed: "ChangeFeed", since: int, maxsize: int, loop: asyncio.AbstractEventLoop):
+        super().__init__(feed, since, maxsize)
+        self._loop = loop
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize)
+
+    def _push(self, changes: List[NoteChange]):
+        try:
+            self._loop.call_soon_threadsafe(self._put, changes)
+        except RuntimeError:
+            pass  # loop уже закрыт
+
+    def _put(self, changes: List[NoteChange]):
+        super()._push(changes)
+
+    def _start_catch_up(self) -> bool:
+        # всё в потоке event loop, _put сюда не вклинится
+        if not self._behind:
+            return False
+        self._behind = False
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        return True
+
+    def _catch_up_done(self, changes: List[NoteChange]):
+        if len(changes) == READ_BATCH:
+            self._behind = True
+
+    async def next(self, timeout: Optional[float] = None) -> List[NoteChange]:
+        if self._start_catch_up():
+            changes = await asyncio.to_thread(self._feed.read_since, self.last_seq)
+            self._catch_up_done(changes)
+            if changes:
+                return self._fresh(changes)
+        try:
+            changes = [await asyncio.wait_for(self._queue.get(), timeout)]
+        except asyncio.TimeoutError:
+            return []
+        while not self._queue.empty():
+            changes.append(self._queue.get_nowait())
+        return self._fresh(changes)
+
+
+class ChangeFeed:
+    def __init__(
+        self,
+        session_factory: sessionmaker = SessionLocal,
+        poll_interval: float = 1.0,
+        gap_grace: float = 2.0,
+        retention_sec: float = CHANGE_FEED_RETENTION_SEC,
+        queue_size: int = CHANGE_FEED_QUEUE_SIZE,
+    ):
+        self._session_factory = session_factory
+        self._engine = session_factory.kw["bind"]
+        self._poll_interval = poll_interval
+        # seq выдаются до commit, поэтому транзакции видны не по порядку:
+        # дыру в seq ждём gap_grace секунд, потом считаем её откатом
+        self._gap_grace = gap_grace
+        self._gap: Optional[tuple] = None
+        self._retention_sec = retention_sec
+        self._queue_size = queue_size
+        self._lock = threading.Lock()
+        self._subscribers: List[Subscription] = []
+        self._watermark: Optional[int] = None  # все seq <= watermark уже разосланы
+        self._next_prune = 0.0
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="change-feed", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def stats(self):
+        return {"watermark": self._watermark, "subscribers": len(self._subscribers)}
+
+    # since = 0 -> только новые изменения; иначе продолжение после since
+    def subscribe(self, since: int = 0) -> Subscription:
+        if since:
+            self._check_resume(since)
+        return self._register(Subscription, since)
+
+    async def asubscribe(self, since: int = 0) -> AsyncSubscription:
+        loop = asyncio.get_running_loop()
+        if since:
+            await asyncio.to_thread(self._check_resume, since)
+        return self._register(lambda *args: AsyncSubscription(*args, loop=loop), since)
+
+    def _register(self, factory, since: int):
+        with self._lock:
+            start = since or (self._watermark if self._watermark is not None else self._max_seq())
+            subscription = factory(self, start, self._queue_size)
+            self._subscribers.append(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            if subscription in self._subscribers:
+                self._subscribers.remove(subscription)
+
+    def _check_resume(self, since: int):
+        with self._session_factory() as session:
+            oldest = session.scalar(select(func.min(NoteChangeORM.seq)))
+        if oldest is not None and since + 1 < oldest:
+            raise ResumeExpired(f"changes after {since} are no longer retained")
+
+    def _max_seq(self) -> int:
+        with self._session_factory() as session:
+            return session.scalar(select(func.max(NoteChangeORM.seq))) or 0
+
+    def read_since(self, since: int, limit: int = READ_BATCH) -> List[NoteChange]:
+        watermark = self._watermark
+        if watermark is None or since >= watermark:
+            return []
+        with self._session_factory() as session:
+            rows = session.scalars(
+                select(NoteChangeORM)
+                .where(NoteChangeORM.seq > since, NoteChangeORM.seq <= watermark)
+                .order_by(NoteChangeORM.seq)
+                .limit(limit)
+            ).all()
+            return [_to_change(r) for r in rows]
+
+    def _conninfo(self) -> str:
+        return self._engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                with psycopg.connect(self._conninfo(), autocommit=True) as conn:
+                    conn.execute(f"LISTEN {CHANGES_CHANNEL}")
+                    if self._watermark is None:
+                        self._watermark = self._max_seq()
+                    while not self._stopped.is_set():
+                        while self.poll():
+                            pass
+                        # NOTIFY только будит; если уведомление потерялось, журнал всё равно перечитается
+                        for _ in conn.notifies(timeout=self._poll_interval, stop_after=1):
+                            pass
+            except Exception:
+                log.exception("change feed listener failed, reconnecting")
+                self._stopped.wait(self._poll_interval)
+
+    def poll(self) -> bool:
+        # True -> прочитана полная порция, в журнале может быть ещё
+        now = time.monotonic()
+        with self._session_factory() as session:
+            rows = session.scalars(
+                select(NoteChangeORM)
+                .where(NoteChangeORM.seq > self._watermark)
+                .order_by(NoteChangeORM.seq)
+                .limit(READ_BATCH)
+            ).all()
+            changes = []
+            expected = self._watermark + 1
+            for row in rows:
+                if row.seq != expected:
+                    if self._gap is None or self._gap[0] != expected:
+                        self._gap = (expected, now)
+                    if now - self._gap[1] < self._gap_grace:
+                        break
+                changes.append(_to_change(row))
+                expected = row.seq + 1
+
+        if changes:
+            with self._lock:
+                self._watermark = changes[-1].seq
+                for subscription in self._subscribers:
+                    subscription._push(changes)
+
+        if now >= self._next_prune:
+            self._next_prune = now + 60
+            self._prune()
+        return len(changes) == READ_BATCH
+
+    def _prune(self):
+        # самая старая оставшаяся строка - граница, по ней проверяется возобновление
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self._retention_sec)
+        with self._session_factory() as session:
+            boundary = session.scalar(
+                select(func.max(NoteChangeORM.seq)).where(NoteChangeORM.changed_at < cutoff)
+            )
+            if boundary is not None:
+                session.execute(delete(NoteChangeORM).where(NoteChangeORM.seq < boundary))
+                session.commit()
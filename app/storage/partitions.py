@@ -0,0 +1,167 @@
+import logging
+import os
+import re
+import threading
+from datetime import datetime, timezone
+from typing import Callable, List, Optional, Sequence
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+# Партиции notes по created_at: заранее создаём NOTES_PARTITIONS_AHEAD следующих интервалов,
+# партиции старше NOTES_PARTITION_RETENTION интервалов отсоединяем (DETACH). Отсоединённая
+# партиция остаётся обычной таблицей notes_pYYYYMM[DD]: её можно выгрузить в архив и удалить.
+
+log = logging.getLogger(__name__)
+
+NOTES_PARTITION_INTERVAL = os.getenv("NOTES_PARTITION_INTERVAL", "month")  # month | day
+NOTES_PARTITIONS_AHEAD = int(os.getenv("NOTES_PARTITIONS_AHEAD", "3"))
+NOTES_PARTITION_RETENTION = int(os.getenv("NOTES_PARTITION_RETENTION", "0"))  # 0 - ничего не отсоединять
+
+# создание и отсоединение партиции ждут блокировку notes; не дождались - попробуем на следующей проверке
+LOCK_TIMEOUT_MS = 2000
+# две копии приложения не должны создавать одни и те же партиции одновременно
+ADVISORY_LOCK_ID = 0x6E6F746573  # "notes"
+
+_NAME = re.compile(r"^notes_p(\d{6}|\d{8})$")
+# сюда попадают строки вне созданных партиций (db_models.py)
+DEFAULT_PARTITION = "notes_default"
+
+
+def _floor(moment: datetime, interval: str) -> datetime:
+    if interval == "day":
+        return datetime(moment.year, moment.month, moment.day, tzinfo=timezone.utc)
+    return datetime(moment.year, moment.month, 1, tzinfo=timezone.utc)
+
+
+def _shift(start: datetime, interval: str, n: int) -> datetime:
+    if interval == "day":
+        return datetime.fromordinal(start.toordinal() + n).replace(tzinfo=timezone.utc)
+    month = start.month - 1 + n
+    return datetime(start.year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def _name(start: datetime, interval: str) -> str:
+    return "notes_p" + start.strftime("%Y%m%d" if interval == "day" else "%Y%m")
+
+
+def _parse_name(name: str) -> Optional[datetime]:
+    m = _NAME.match(name)
+    if m is None:
+        return None
+    digits = m.group(1)
+    return datetime.strptime(digits, "%Y%m%d" if len(digits) == 8 else "%Y%m").replace(tzinfo=timezone.utc)
+
+
+class PartitionManager:
+    def __init__(
+        self,
+        engine: Engine,
+        interval: str = NOTES_PARTITION_INTERVAL,
+        ahead: int = NOTES_PARTITIONS_AHEAD,
+        retention: int = NOTES_PARTITION_RETENTION,
+        check_interval: float = 3600.0,
+        jobs: Sequence[Callable[[Engine], object]] = (),
+    ):
+        if interval not in ("month", "day"):
+            raise ValueError(f"unsupported partition interval: {interval}")
+        self._engine = engine
+        self._interval = interval
+        self._ahead = ahead
+        self._retention = retention
+        self._check_interval = check_interval
+        # прочее периодическое обслуживание той же БД (чистка истёкших ключей идемпотентности и т.п.)
+        self._jobs = list(jobs)
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="notes-partitions", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self._check_interval):
+            try:
+                self.ensure()
+            except Exception:
+                log.exception("notes partition maintenance failed")
+            for job in self._jobs:
+                try:
+                    job(self._engine)
+                except Exception:
+                    log.exception("maintenance job %s failed", getattr(job, "__name__", job))
+
+    def _is_partitioned(self, conn) -> bool:
+        return conn.execute(text(
+            "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('notes')"
+        )).first() is not None
+
+    def _attached(self, conn) -> List[str]:
+        return list(conn.execute(text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = to_regclass('notes')"
+        )).scalars())
+
+    def ensure(self, now: Optional[datetime] = None):
+        if self._engine.dialect.name != "postgresql":
+            return
+        now = now or datetime.now(timezone.utc)
+        current = _floor(now, self._interval)
+        with self._engine.begin() as conn:
+            if not self._is_partitioned(conn):
+                log.warning("table notes is not partitioned, partition maintenance is skipped")
+                return
+            conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": ADVISORY_LOCK_ID})
+            conn.exec_driver_sql(f"SET LOCAL lock_timeout = {LOCK_TIMEOUT_MS}")
+            attached = set(self._attached(conn))
+            for n in range(self._ahead + 1):
+                start = _shift(current, self._interval, n)
+                name = _name(start, self._interval)
+                if name in attached:
+                    continue
+                end = _shift(start, self._interval, 1)
+                # параметры в DDL не передать, границы - литералы (значения свои, не от клиента)
+                bounds = f"FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+                if DEFAULT_PARTITION in attached and self._default_has_rows(conn, start, end):
+                    self._create_from_default(conn, name, start, end, bounds)
+                    continue
+                conn.exec_driver_sql(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF notes FOR VALUES {bounds}")
+                log.info("created partition %s", name)
+
+        if self._retention > 0:
+            self._detach_old(_shift(current, self._interval, -self._retention))
+
+    def _default_has_rows(self, conn, start: datetime, end: datetime) -> bool:
+        return conn.execute(
+            text(f"SELECT 1 FROM {DEFAULT_PARTITION} WHERE created_at >= :start AND created_at < :end LIMIT 1"),
+            {"start": start, "end": end},
+        ).first() is not None
+
+    def _create_from_default(self, conn, name: str, start: datetime, end: datetime, bounds: str):
+        # строки интервала уже лежат в DEFAULT (проверка отстала, заметка с датой вне партиций) -
+        # PARTITION OF на таком интервале падает. Создаём таблицу отдельно, переносим в неё строки
+        # и подключаем как партицию; всё в транзакции ensure
+        conn.exec_driver_sql(f"CREATE TABLE {name} (LIKE notes INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+        moved = conn.exec_driver_sql(
+            f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} "
+            f"WHERE created_at >= '{start.isoformat()}' AND created_at < '{end.isoformat()}' RETURNING *) "
+            f"INSERT INTO {name} SELECT * FROM moved"
+        ).rowcount
+        conn.exec_driver_sql(f"ALTER TABLE notes ATTACH PARTITION {name} FOR VALUES {bounds}")
+        log.info("created partition %s, moved %d rows from %s", name, moved, DEFAULT_PARTITION)
+
+    def _detach_old(self, cutoff: datetime):
+        # отдельная транзакция на каждую партицию: DETACH держит эксклюзивную блокировку notes
+        with self._engine.connect() as conn:
+            names = self._attached(conn)
+        for name in sorted(names):
+            start = _parse_name(name)
+            if start is None or _shift(start, self._interval, 1) > cutoff:
+                continue
+            with self._engine.begin() as conn:
+                conn.exec_driver_sql(f"SET LOCAL lock_timeout = {LOCK_TIMEOUT_MS}")
+                conn.exec_driver_sql(f"ALTER TABLE notes DETACH PARTITION {name}")
+            log.info("detached partition %s", name)
@@ -1,16 +1,125 @@
-from datetime import datetime, timezone
-from typing import List
+import functools
+import hashlib
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional, Sequence
 
-from sqlalchemy.orm import Session
+from sqlalchemy import delete, select, text, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session, sessionmaker
 
-from app.core.errors import NoteNotFound
-from app.core.models import Note
-from app.db import SessionLocal
-from app.db_models import NoteORM
+from app.core.context import RequestContext, current
+from app.core.ids import id_time
+from app.core.errors import IdempotencyConflict, NoteNotFound
+from app.core.models import NOTE_FIELDS, Mutation, Note
+from app.db import SessionLocal, STATEMENT_TIMEOUT_MS, STATEMENT_TIMEOUT_SLACK_MS
+from app.db_pool import monitor_for
+from app.db_models import IdempotencyKeyORM, NoteChangeORM, NoteORM
 from app.storage.base import Base
 
+log = logging.getLogger(__name__)
+
+REPLICA_RETRY_SEC = 5.0
+# токен read-your-writes без позиции WAL: чтения с ним идут только на primary
+PRIMARY_LSN = "primary"
+IDEMPOTENCY_TTL_SEC = float(os.getenv("IDEMPOTENCY_TTL_SEC", "86400"))
+# created_at ставится при вставке, время в UUIDv7 - при генерации id; запас на расхождение часов
+ID_TIME_WINDOW = timedelta(hours=1)
+
+
+def _parse_lsn(lsn: str) -> int:
+    # pg_lsn "16/B374D848" -> число для сравнения
+    hi, lo = lsn.split("/")
+    return (int(hi, 16) << 32) | int(lo, 16)
+
+
+def _key_digest(key: str) -> bytes:
+    return hashlib.sha256(key.encode()).digest()
+
+
+def _request_hash(op: str, note_id: Optional[str], description: Optional[str]) -> bytes:
+    return hashlib.sha256(f"{op}\0{note_id or ''}\0{description or ''}".encode()).digest()
+
+
+def prune_idempotency_keys(engine: Engine, batch: int = 1000) -> int:
+    # истёкшие ключи удаляются фоном (PartitionManager), порциями в отдельных транзакциях
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=IDEMPOTENCY_TTL_SEC)
+    expired = select(IdempotencyKeyORM.key).where(IdempotencyKeyORM.created_at < cutoff).limit(batch)
+    pruned = 0
+    while True:
+        with engine.begin() as conn:
+            deleted = conn.execute(delete(IdempotencyKeyORM).where(IdempotencyKeyORM.key.in_(expired))).rowcount
+        pruned += deleted
+        if deleted < batch:
+            return pruned
+
+
+def _retry_disconnect(method):
+    # Вместо pool_pre_ping: соединение, разорванное между проверками PoolMonitor (рестарт БД, failover),
+    # ломает первый запрос на нём, и SQLAlchemy выбрасывает весь пул. Чтение повторяем один раз -
+    # уже на новом соединении. Записи не повторяются: неизвестно, дошёл ли commit
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except DBAPIError as e:
+            if not e.connection_invalidated or current().expired():
+                raise
+            log.warning("database connection lost, retrying read: %s", e.orig)
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _columns(fields: Optional[Sequence[str]]) -> list:
+    # только запрошенные столбцы: без description Postgres не читает его TOAST
+    return [getattr(NoteORM, f) for f in (fields or NOTE_FIELDS)]
+
+
+def _single(rows: list, note_id: str):
+    # первичный ключ notes - (id, created_at), уникальность самого id держится на том, что он всегда
+    # новый UUIDv7. Две строки с одним id - испорченные данные: молча брать первую нельзя
+    if len(rows) > 1:
+        log.error("note id %s is not unique in notes", note_id)
+        raise RuntimeError(f"duplicate note id {note_id}")
+    return rows[0] if rows else None
+
+
+def _by_id(note_id: str) -> list:
+    # условие по created_at из времени в id: план затрагивает одну-две партиции notes, а не все
+    where = [NoteORM.id == note_id]
+    created = id_time(note_id)
+    if created is not None:
+        where += [NoteORM.created_at >= created - ID_TIME_WINDOW, NoteORM.created_at < created + ID_TIME_WINDOW]
+    return where
+
+
+class _Replica:
+    def __init__(self, session_factory: sessionmaker):
+        self.session_factory = session_factory
+        self.engine = session_factory.kw["bind"]
+        self.down_until = 0.0
+        # последний увиденный LSN, до которого реплика применила WAL
+        self.replay_lsn = 0
+
+    def load(self) -> int:
+        return self.engine.pool.checkedout()
+
 
 class PostgresStorage(Base):
+    def __init__(
+        self,
+        session_factory: sessionmaker = SessionLocal,
+        replica_factories: Sequence[sessionmaker] = (),
+        change_log: bool = False,
+    ):
+        self._session_factory = session_factory
+        self._replicas = [_Replica(f) for f in replica_factories]
+        # журнал note_changes для WatchNotes пишется в той же транзакции, что и изменение
+        self._change_log = change_log
 
     def _to_note(self, orm: NoteORM) -> Note:
         return Note(
@@ -20,54 +129,343 @@ class PostgresStorage(Base):
             updated_at=orm.updated_at,
         )
 
-    def _get_session(self) -> Session:
-        return SessionLocal()
+    def _get_session(self, read: bool = False) -> Session:
+        ctx = current()
+        ctx.check()
+        session = self._replica_session(ctx) if read and self._replicas else None
+        if session is None:
+            session = self._session_factory()
+            try:
+                with ctx.span("db_pool"):
+                    monitor_for(self._session_factory.kw["bind"]).acquire(session)  # checkout из пула
+            except BaseException:
+                session.close()
+                raise
+        if ctx.deadline is None:
+            return session
+        try:
+            ctx.check()
+            remaining_ms = int(ctx.remaining() * 1000)
+            # отдельный запрос к БД на транзакцию - только если бюджет заметно меньше общего statement_timeout:
+            # дедлайн попытки от LB почти всегда чуть меньше его, и ради пары сотен мс round trip не окупается
+            if remaining_ms < STATEMENT_TIMEOUT_MS - STATEMENT_TIMEOUT_SLACK_MS:
+                # только на эту транзакцию; после commit снова действует общий statement_timeout
+                session.execute(
+                    text("SELECT set_config('statement_timeout', :ms, true)"),
+                    {"ms": str(max(remaining_ms, 1))},
+                )
+        except BaseException:
+            session.close()
+            raise
+        return session
+
+    def _find(self, session: Session, note_id: str) -> Optional[NoteORM]:
+        return _single(session.scalars(select(NoteORM).where(*_by_id(note_id)).limit(2)).all(), note_id)
+
+    def _replica_session(self, ctx: RequestContext) -> Optional[Session]:
+        # None -> читать с primary
+        if ctx.min_lsn == PRIMARY_LSN:
+            return None
+        try:
+            min_lsn = _parse_lsn(ctx.min_lsn) if ctx.min_lsn else 0
+        except ValueError:
+            return None
+
+        now = time.monotonic()
+        alive = [r for r in self._replicas if r.down_until <= now]
+        if not alive:
+            return None
+        # сначала реплики, которые заведомо догнали токен клиента, среди них - наименее загруженная
+        replica = min(alive, key=lambda r: (r.replay_lsn < min_lsn, r.load()))
+
+        session = replica.session_factory()
+        try:
+            with ctx.span("db_pool"):
+                monitor_for(replica.engine).acquire(session)
+            if min_lsn > replica.replay_lsn:
+                replayed = session.execute(text("SELECT pg_last_wal_replay_lsn()::text")).scalar()
+                replica.replay_lsn = _parse_lsn(replayed) if replayed else 0
+                if replica.replay_lsn < min_lsn:
+                    session.close()
+                    return None
+        except Exception:
+            session.close()
+            replica.down_until = now + REPLICA_RETRY_SEC
+            return None
+        return session
+
+    def _log_change(self, session: Session, op: str, note):
+        # note - NoteORM или снимок Note на момент операции
+        if not self._change_log:
+            return
+        deleted = op == "delete"
+        session.add(NoteChangeORM(
+            op=op,
+            note_id=note.id,
+            description=None if deleted else note.description,
+            created_at=None if deleted else note.created_at,
+            updated_at=None if deleted else note.updated_at,
+        ))
+
+    def _claim(
+        self,
+        session: Session,
+        key: Optional[str],
+        op: str,
+        note_id: Optional[str] = None,
+        description: Optional[str] = None,
+    ):
+        # None -> ключа нет (или он истёк) и теперь он за этой транзакцией; иначе строка с прошлым результатом.
+        # Одновременный повтор с тем же ключом ждёт на вставке, пока первая транзакция не завершится.
+        if not key:
+            return None
+        now = datetime.now(timezone.utc)
+        digest = _key_digest(key)
+        request_hash = _request_hash(op, note_id, description)
+        stmt = pg_insert(IdempotencyKeyORM).values(
+            key=digest, op=op, request_hash=request_hash, note_id=note_id, created_at=now
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[IdempotencyKeyORM.key],
+            set_={
+                "op": op,
+                "request_hash": request_hash,
+                "note_id": note_id,
+                "note_created_at": None,
+                "note_updated_at": None,
+                "created_at": now,
+            },
+            where=IdempotencyKeyORM.created_at < now - timedelta(seconds=IDEMPOTENCY_TTL_SEC),
+        ).returning(IdempotencyKeyORM.key)
+        if session.execute(stmt).first() is not None:
+            return None
+        stored = session.get(IdempotencyKeyORM, digest)
+        if stored.request_hash != request_hash:
+            raise IdempotencyConflict("idempotency key was already used for another request")
+        return stored
+
+    def _remember(self, session: Session, key: Optional[str], note):
+        if not key:
+            return
+        session.execute(
+            update(IdempotencyKeyORM)
+            .where(IdempotencyKeyORM.key == _key_digest(key))
+            .values(note_id=note.id, note_created_at=note.created_at, note_updated_at=note.updated_at)
+        )
+
+    def _release(self, session: Session, key: Optional[str]):
+        # операция не выполнилась: ключ не занимаем, повтор выполнит её заново
+        if key:
+            session.execute(delete(IdempotencyKeyORM).where(IdempotencyKeyORM.key == _key_digest(key)))
 
-    def create(self, description: str) -> Note:
+    def _replay(self, session: Session, stored: IdempotencyKeyORM) -> Optional[Note]:
+        # повтор отдаёт заметку в текущем виде; удалённая с тех пор - NoteNotFound
+        if stored.op == "delete":
+            return None
+        note_orm = session.scalars(
+            select(NoteORM).where(NoteORM.id == stored.note_id, NoteORM.created_at == stored.note_created_at)
+        ).first()
+        if note_orm is None:
+            raise NoteNotFound(f"note {stored.note_id} not found")
+        return self._to_note(note_orm)
+
+    def _commit(self, session: Session):
+        session.commit()
+        if not self._replicas:
+            return
+        # токен read-your-writes (клиент передаёт его обратно в следующих чтениях) - позиция WAL уже после
+        # записи COMMIT: реплика, применившая его, видит эту запись. Позиция вставки общая для сервера,
+        # так что годится любое соединение с primary (и при synchronous_commit=off тоже).
+        # Запись уже зафиксирована, поэтому ошибка здесь её не отменяет: клиент получает токен,
+        # который отправляет его чтения на primary
+        try:
+            current().lsn = session.execute(text("SELECT pg_current_wal_insert_lsn()::text")).scalar()
+        except Exception:
+            log.warning("failed to read WAL position after commit, reads will go to primary", exc_info=True)
+            current().lsn = PRIMARY_LSN
+
+    def create(self, description: str, note_id: Optional[str] = None) -> Note:
+        key = current().idempotency_key
         with self._get_session() as session:
+            stored = self._claim(session, key, "create", description=description)
+            if stored is not None:
+                note = self._replay(session, stored)
+                self._commit(session)
+                return note
+
             note_orm = NoteORM(
                 description=description,
-                # created_at и id зададутся через default в модели
+                # created_at и id (если не задан) зададутся через default в модели
+                **({"id": note_id} if note_id else {}),
             )
             session.add(note_orm)
-            session.commit()
+            if self._change_log or key:
+                session.flush()  # id и даты нужны для журнала и ключа идемпотентности
+                self._log_change(session, "create", note_orm)
+                self._remember(session, key, note_orm)
+            self._commit(session)
             session.refresh(note_orm)  # подтянуть id/created_at из БД
             return self._to_note(note_orm)
 
-    def get(self, note_id: str) -> Note:
-        with self._get_session() as session:
-            note_orm = session.get(NoteORM, note_id)
-            if note_orm is None:
+    @_retry_disconnect
+    def get(self, note_id: str, fields: Optional[Sequence[str]] = None) -> Note:
+        with self._get_session(read=True) as session:
+            row = _single(session.execute(select(*_columns(fields)).where(*_by_id(note_id)).limit(2)).all(), note_id)
+            if row is None:
                 raise NoteNotFound(f"note {note_id} not found")
-            return self._to_note(note_orm)
+            return Note(**row._mapping)
 
-    def list(self) -> list[Note]:
-        with self._get_session() as session:
-            notes_orm = (
-                session.query(NoteORM)
+    @_retry_disconnect
+    def list(self, limit: Optional[int] = None, offset: int = 0, fields: Optional[Sequence[str]] = None) -> list[Note]:
+        with self._get_session(read=True) as session:
+            rows = session.execute(
+                select(*_columns(fields))
+                .order_by(NoteORM.created_at.desc())
+                .offset(offset or None)
+                .limit(limit)
+            )
+            return [Note(**row._mapping) for row in rows]
+
+    def iter_list(self, fields: Optional[Sequence[str]] = None, chunk_size: int = 500) -> Iterator[Note]:
+        # yield_per -> серверный курсор, строки читаются порциями
+        with self._get_session(read=True) as session:
+            rows = session.execute(
+                select(*_columns(fields))
                 .order_by(NoteORM.created_at.desc())
-                .all()
+                .execution_options(yield_per=chunk_size)
             )
-            return [self._to_note(row) for row in notes_orm]
+            for row in rows:
+                yield Note(**row._mapping)
 
     def update_description(self, note_id: str, description: str) -> Note:
+        key = current().idempotency_key
         with self._get_session() as session:
-            note_orm = session.get(NoteORM, note_id)
+            stored = self._claim(session, key, "update", note_id, description)
+            if stored is not None:
+                note = self._replay(session, stored)
+                self._commit(session)
+                return note
+
+            note_orm = self._find(session, note_id)
             if note_orm is None:
                 raise NoteNotFound(f"note {note_id} not found")
 
             note_orm.description = description
             note_orm.updated_at = datetime.now(timezone.utc)
-            session.commit()
+            self._log_change(session, "update", note_orm)
+            self._remember(session, key, note_orm)
+            self._commit(session)
             session.refresh(note_orm)
             return self._to_note(note_orm)
 
 
     def delete(self, note_id: str) -> None:
         with self._get_session() as session:
-            note_orm = session.get(NoteORM, note_id)
+            if self._claim(session, current().idempotency_key, "delete", note_id) is not None:
+                self._commit(session)
+                return
+
+            note_orm = self._find(session, note_id)
             if note_orm is None:
                 raise NoteNotFound(f"note {note_id} not found")
 
             session.delete(note_orm)
-            session.commit()
+            self._log_change(session, "delete", note_orm)
+            self._commit(session)
+
+    def import_note(self, note: Note) -> None:
+        # перенос заметки как есть (id и даты сохраняются); более свежая версия не затирается
+        stmt = pg_insert(NoteORM).values(
+            id=note.id,
+            description=note.description,
+            created_at=note.created_at,
+            updated_at=note.updated_at,
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[NoteORM.id, NoteORM.created_at],
+            set_={"description": stmt.excluded.description, "updated_at": stmt.excluded.updated_at},
+            where=NoteORM.updated_at < stmt.excluded.updated_at,
+        )
+        with self._get_session() as session:
+            session.execute(stmt)
+            self._commit(session)
+
+    def delete_if_unchanged(self, note_id: str, updated_at: datetime) -> bool:
+        with self._get_session() as session:
+            deleted = session.execute(
+                delete(NoteORM).where(*_by_id(note_id), NoteORM.updated_at == updated_at)
+            ).rowcount
+            self._commit(session)
+            return deleted > 0
+
+    def apply_batch(self, mutations: List[Mutation]) -> List:
+        # вся пачка - одна транзакция и один commit
+        with self._get_session() as session:
+            results = []
+            changes = []
+            remember = []
+            deleted = set()
+            keys: Dict[str, int] = {}
+            for m in mutations:
+                key = m.idempotency_key
+                note_id = m.note_id if m.op != "create" else None
+                description = m.description if m.op != "delete" else None
+                if key and key in keys:
+                    # тот же ключ дважды в одной пачке: второй раз отдаём результат первого
+                    first = mutations[keys[key]]
+                    same = (
+                        first.op == m.op
+                        and (m.op == "create" or first.note_id == m.note_id)
+                        and (m.op == "delete" or first.description == m.description)
+                    )
+                    if same:
+                        results.append(results[keys[key]])
+                    else:
+                        results.append(IdempotencyConflict("idempotency key was already used for another request"))
+                    continue
+                try:
+                    stored = self._claim(session, key, m.op, note_id, description)
+                    replayed = self._replay(session, stored) if stored is not None else None
+                except (IdempotencyConflict, NoteNotFound) as e:
+                    results.append(e)
+                    continue
+                if key:
+                    keys[key] = len(results)
+                if stored is not None:
+                    results.append(replayed)
+                    continue
+
+                if m.op == "create":
+                    note_orm = NoteORM(description=m.description, **({"id": m.note_id} if m.note_id else {}))
+                    session.add(note_orm)
+                    results.append(note_orm)
+                    changes.append((m.op, note_orm))
+                    remember.append((key, note_orm))
+                    continue
+
+                note_orm = None if m.note_id in deleted else self._find(session, m.note_id)
+                if note_orm is None:
+                    self._release(session, key)
+                    results.append(NoteNotFound(f"note {m.note_id} not found"))
+                elif m.op == "update":
+                    note_orm.description = m.description
+                    note_orm.updated_at = datetime.now(timezone.utc)
+                    results.append(self._to_note(note_orm))
+                    changes.append((m.op, self._to_note(note_orm)))
+                    remember.append((key, self._to_note(note_orm)))
+                else:
+                    session.delete(note_orm)
+                    deleted.add(m.note_id)
+                    results.append(None)
+                    changes.append((m.op, note_orm))
+
+            if (self._change_log and changes) or any(key for key, _ in remember):
+                session.flush()
+                # порядок seq в журнале = порядок операций в пачке
+                for op, note in changes:
+                    self._log_change(session, op, note)
+                for key, note in remember:
+                    self._remember(session, key, note)
+            self._commit(session)
+            # id/created_at у новых заметок проставлены default'ами при flush
+            return [self._to_note(r) if isinstance(r, NoteORM) else r for r in results]
@@ -0,0 +1,192 @@
+import bisect
+import contextvars
+import hashlib
+import heapq
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence
+
+from app.core.context import current
+from app.core.errors import NoteNotFound, ValidationError
+from app.core.ids import new_id
+from app.core.models import Mutation, Note
+from app.storage.base import Base
+
+log = logging.getLogger(__name__)
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    # консистентное хэширование: при добавлении шарда переезжает ~1/N заметок
+    def __init__(self, names, vnodes: int = 64):
+        self._points = sorted((_hash(f"{name}#{i}"), name) for name in names for i in range(vnodes))
+        self._keys = [p for p, _ in self._points]
+
+    def owner(self, note_id: str) -> str:
+        i = bisect.bisect(self._keys, _hash(note_id)) % len(self._keys)
+        return self._points[i][1]
+
+
+class ShardedStorage(Base):
+    # шарды - обычные хранилища (PostgresStorage на своей БД), маршрутизация по хэшу id
+    def __init__(
+        self,
+        shards: Dict[str, Base],
+        vnodes: int = 64,
+        previous: Optional[List[str]] = None,
+        workers: Optional[int] = None,
+    ):
+        self._shards = dict(shards)
+        self._vnodes = vnodes
+        self._ring = HashRing(self._shards, vnodes)
+        # пока идёт ребалансировка, заметка может ещё лежать у прежнего владельца
+        self._previous_ring = HashRing(previous, vnodes) if previous else None
+        self._lock = threading.Lock()
+        # запрос к шарду из list() и apply_batch не должен ждать в очереди за чужими запросами:
+        # потоков - на все одновременные вызовы, которые пропускает admission control (workers),
+        # потоки пула создаются по мере надобности
+        self._pool = ThreadPoolExecutor(max_workers=workers or max(len(self._shards), 4), thread_name_prefix="shards")
+
+    def _submit(self, fn: Callable, *args):
+        # контекст запроса (дедлайн и т.п.) переносим в поток пула
+        return self._pool.submit(contextvars.copy_context().run, fn, *args)
+
+    def _candidates(self, note_id: str) -> List[Base]:
+        owner = self._ring.owner(note_id)
+        names = [owner]
+        previous = self._previous_ring
+        if previous is not None and previous.owner(note_id) != owner:
+            names.append(previous.owner(note_id))
+        return [self._shards[n] for n in names]
+
+    def _new_id(self, idempotency_key: Optional[str]) -> str:
+        # id всегда новый UUIDv7 (уникальность id в notes держится на этом). Повтор с тем же ключом должен
+        # попасть на шард, где лежит сохранённый результат: берём id, который кольцо отдаёт владельцу ключа
+        # (в среднем столько попыток, сколько шардов)
+        ring = self._ring
+        note_id = new_id()
+        if not idempotency_key:
+            return note_id
+        owner = ring.owner(f"idempotency:{idempotency_key}")
+        while ring.owner(note_id) != owner:
+            note_id = new_id()
+        return note_id
+
+    def _on_candidates(self, note_id: str, fn: Callable[[Base], object]):
+        candidates = self._candidates(note_id)
+        if len(candidates) > 1:
+            # новый владелец, прежний и снова новый: заметку могли перенести между попытками
+            candidates.append(candidates[0])
+        for shard in candidates:
+            try:
+                return fn(shard)
+            except NoteNotFound:
+                continue
+        raise NoteNotFound(f"note {note_id} not found")
+
+    def create(self, description: str) -> Note:
+        note_id = self._new_id(current().idempotency_key)
+        return self._shards[self._ring.owner(note_id)].create(description, note_id=note_id)
+
+    def get(self, note_id: str, fields: Optional[Sequence[str]] = None) -> Note:
+        return self._on_candidates(note_id, lambda shard: shard.get(note_id, fields=fields))
+
+    def update_description(self, note_id: str, description: str) -> Note:
+        return self._on_candidates(note_id, lambda shard: shard.update_description(note_id, description))
+
+    def delete(self, note_id: str) -> None:
+        return self._on_candidates(note_id, lambda shard: shard.delete(note_id))
+
+    def list(self, limit: Optional[int] = None, offset: int = 0, fields: Optional[Sequence[str]] = None) -> list[Note]:
+        # каждый шард отдаёт свои первые offset+limit, дальше k-way merge по created_at
+        per_shard = None if limit is None else offset + limit
+        if fields is not None and "created_at" not in fields:
+            fields = tuple(fields) + ("created_at",)  # нужен для слияния
+        futures = [self._submit(shard.list, per_shard, 0, fields) for shard in self._shards.values()]
+        parts = [f.result() for f in futures]
+
+        seen = set()
+        merged = []
+        for note in heapq.merge(*parts, key=lambda n: n.created_at, reverse=True):
+            # во время переноса заметка ненадолго видна на двух шардах
+            if note.id in seen:
+                continue
+            seen.add(note.id)
+            merged.append(note)
+        end = None if limit is None else offset + limit
+        return merged[offset:end]
+
+    def apply_batch(self, mutations: List[Mutation]) -> List:
+        groups: Dict[str, list] = {}
+        for i, m in enumerate(mutations):
+            if m.op == "create":
+                m = Mutation(
+                    op="create",
+                    note_id=self._new_id(m.idempotency_key),
+                    description=m.description,
+                    idempotency_key=m.idempotency_key,
+                )
+            groups.setdefault(self._ring.owner(m.note_id), []).append((i, m))
+
+        futures = {
+            name: self._submit(self._shards[name].apply_batch, [m for _, m in items])
+            for name, items in groups.items()
+        }
+        results = [None] * len(mutations)
+        for name, items in groups.items():
+            for (i, m), result in zip(items, futures[name].result()):
+                if isinstance(result, NoteNotFound) and self._previous_ring is not None:
+                    result = self._retry_single(m)
+                results[i] = result
+        return results
+
+    def _retry_single(self, m: Mutation):
+        ctx = current()
+        previous_key, ctx.idempotency_key = ctx.idempotency_key, m.idempotency_key
+        try:
+            if m.op == "update":
+                return self.update_description(m.note_id, m.description)
+            self.delete(m.note_id)
+            return None
+        except (NoteNotFound, ValidationError) as e:
+            return e
+        finally:
+            ctx.idempotency_key = previous_key
+
+    def add_shard(self, name: str, shard: Base):
+        with self._lock:
+            self._previous_ring = HashRing(self._shards, self._vnodes)
+            self._shards[name] = shard
+            self._ring = HashRing(self._shards, self._vnodes)
+
+    def rebalance(self) -> int:
+        # переносим заметки, у которых сменился владелец: копия на новый шард,
+        # затем удаление со старого, только если её не успели изменить
+        moved = 0
+        for name, shard in list(self._shards.items()):
+            for note in shard.iter_list():
+                owner = self._ring.owner(note.id)
+                if owner != name:
+                    moved += self._move(note, shard, self._shards[owner])
+        with self._lock:
+            self._previous_ring = None
+        log.info("rebalance finished, moved %d notes", moved)
+        return moved
+
+    def _move(self, note: Note, source: Base, target: Base, attempts: int = 3) -> int:
+        for _ in range(attempts):
+            target.import_note(note)
+            if source.delete_if_unchanged(note.id, note.updated_at):
+                return 1
+            try:
+                note = source.get(note.id)
+            except NoteNotFound:
+                # удалили, пока копировали: копию тоже убираем
+                target.delete_if_unchanged(note.id, note.updated_at)
+                return 0
+        log.warning("note %s kept changing, will move on next rebalance", note.id)
+        return 0
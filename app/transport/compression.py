@@ -0,0 +1,158 @@
+import os
+import zlib
+from typing import Optional
+
+from starlette.concurrency import run_in_threadpool
+
+try:
+    import zstandard
+except ImportError:  # zstd необязателен
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:  # brotli необязателен
+    brotli = None
+
+# Сжатие ответов REST и SOAP по Accept-Encoding: zstd, br или gzip (что есть и что принимает клиент).
+# Потоковые ответы (ListNotes) сжимаются по частям, каждая часть сразу уходит клиенту.
+
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+# большие тела сжимаются в пуле потоков, чтобы не держать event loop
+THREAD_MIN_BYTES = 256 * 1024
+
+# SSE нельзя буферизовать в компрессоре, gRPC сжимается своими средствами
+EXCLUDED_CONTENT_TYPES = ("text/event-stream", "application/grpc")
+
+
+class _Gzip:
+    encoding = "gzip"
+
+    def __init__(self):
+        self._obj = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        return self._obj.compress(data) + self._obj.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class _Brotli:
+    encoding = "br"
+
+    def __init__(self):
+        self._obj = brotli.Compressor(quality=5)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        out = self._obj.process(data)
+        return out + (self._obj.finish() if final else self._obj.flush())
+
+
+class _Zstd:
+    encoding = "zstd"
+
+    def __init__(self):
+        self._obj = zstandard.ZstdCompressor(level=3).compressobj()
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        out = self._obj.compress(data)
+        return out + self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH if final else zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+
+# в порядке предпочтения сервера
+CODECS = [c for c, available in ((_Zstd, zstandard), (_Brotli, brotli), (_Gzip, True)) if available]
+
+
+def choose_codec(accept_encoding: str):
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    wildcard = accepted.get("*", 0.0)
+    for codec in CODECS:
+        if accepted.get(codec.encoding, wildcard) > 0:
+            return codec
+    return None
+
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size: int = COMPRESS_MIN_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        accept_encoding = ""
+        for key, value in scope["headers"]:
+            if key == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+        codec = choose_codec(accept_encoding)
+        if codec is None:
+            return await self.app(scope, receive, send)
+
+        start: Optional[dict] = None
+        compressor = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start, compressor, passthrough
+            kind = message["type"]
+            if kind == "http.response.start":
+                headers = {k.lower(): v for k, v in message.get("headers", [])}
+                content_type = headers.get(b"content-type", b"").decode("latin-1")
+                passthrough = (
+                    b"content-encoding" in headers
+                    or message["status"] in (204, 206, 304)
+                    or content_type.startswith(EXCLUDED_CONTENT_TYPES)
+                )
+                if passthrough:
+                    return await send(message)
+                start = message  # заголовки отправим, когда станет ясен размер тела
+                return
+            if kind != "http.response.body" or passthrough:
+                return await send(message)
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start is not None:
+                if not more_body and len(body) < self.minimum_size:
+                    await send(_with_vary(start))
+                    start = None
+                    passthrough = True
+                    return await send(message)
+                compressor = codec()
+
+            if len(body) >= THREAD_MIN_BYTES:
+                data = await run_in_threadpool(compressor.compress, body, not more_body)
+            else:
+                data = compressor.compress(body, not more_body)
+            if start is not None:
+                # тело целиком в одном сообщении -> длина известна, иначе chunked
+                await send(_with_encoding(start, codec.encoding, None if more_body else len(data)))
+                start = None
+            await send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
+
+
+def _with_vary(start: dict) -> dict:
+    headers = [(k, v) for k, v in start.get("headers", []) if k.lower() != b"vary"]
+    vary = [v for k, v in start.get("headers", []) if k.lower() == b"vary"]
+    headers.append((b"vary", b", ".join(vary + [b"Accept-Encoding"])))
+    return {**start, "headers": headers}
+
+
+def _with_encoding(start: dict, encoding: str, length: Optional[int]) -> dict:
+    start = _with_vary(start)
+    headers = [(k, v) for k, v in start["headers"] if k.lower() != b"content-length"]
+    headers.append((b"content-encoding", encoding.encode()))
+    if length is not None:
+        headers.append((b"content-length", str(length).encode()))
+    return {**start, "headers": headers}
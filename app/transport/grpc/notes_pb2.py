@@ -22,31 +22,40 @@ _runtime_version.ValidateProtobufRuntimeVersion(
 _sym_db = _symbol_database.Default()
 
 
+from google.protobuf import field_mask_pb2 as google_dot_protobuf_dot_field__mask__pb2
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0bnotes.proto\x12\x08notes.v1\"U\n\x04Note\x12\n\n\x02id\x18\x01 \x01(\t\x12\x13\n\x0b\x64\x65scription\x18\x02 \x01(\t\x12\x15\n\rcreated_at_ms\x18\x03 \x01(\x03\x12\x15\n\rupdated_at_ms\x18\x04 \x01(\x03\"(\n\x11\x43reateNoteRequest\x12\x13\n\x0b\x64\x65scription\x18\x01 \x01(\t\"\x1c\n\x0eGetNoteRequest\x12\n\n\x02id\x18\x01 \x01(\t\"\x12\n\x10ListNotesRequest\"2\n\x11ListNotesResponse\x12\x1d\n\x05notes\x18\x01 \x03(\x0b\x32\x0e.notes.v1.Note\";\n\x18UpdateDescriptionRequest\x12\n\n\x02id\x18\x01 \x01(\t\x12\x13\n\x0b\x64\x65scription\x18\x02 \x01(\t\"\x1f\n\x11\x44\x65leteNoteRequest\x12\n\n\x02id\x18\x01 \x01(\t\"\x07\n\x05\x45mpty2\xc9\x02\n\x0cNotesService\x12\x39\n\nCreateNote\x12\x1b.notes.v1.CreateNoteRequest\x1a\x0e.notes.v1.Note\x12\x33\n\x07GetNote\x12\x18.notes.v1.GetNoteRequest\x1a\x0e.notes.v1.Note\x12\x44\n\tListNotes\x12\x1a.notes.v1.ListNotesRequest\x1a\x1b.notes.v1.ListNotesResponse\x12G\n\x11UpdateDescription\x12\".notes.v1.UpdateDescriptionRequest\x1a\x0e.notes.v1.Note\x12:\n\nDeleteNote\x12\x1b.notes.v1.DeleteNoteRequest\x1a\x0f.notes.v1.Emptyb\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0bnotes.proto\x12\x08notes.v1\x1a google/protobuf/field_mask.proto\"U\n\x04Note\x12\n\n\x02id\x18\x01 \x01(\t\x12\x13\n\x0b\x64\x65scription\x18\x02 \x01(\t\x12\x15\n\rcreated_at_ms\x18\x03 \x01(\x03\x12\x15\n\rupdated_at_ms\x18\x04 \x01(\x03\"(\n\x11\x43reateNoteRequest\x12\x13\n\x0b\x64\x65scription\x18\x01 \x01(\t\"K\n\x0eGetNoteRequest\x12\n\n\x02id\x18\x01 \x01(\t\x12-\n\tread_mask\x18\x02 \x01(\x0b\x32\x1a.google.protobuf.FieldMask\"A\n\x10ListNotesRequest\x12-\n\tread_mask\x18\x01 \x01(\x0b\x32\x1a.google.protobuf.FieldMask\"2\n\x11ListNotesResponse\x12\x1d\n\x05notes\x18\x01 \x03(\x0b\x32\x0e.notes.v1.Note\";\n\x18UpdateDescriptionRequest\x12\n\n\x02id\x18\x01 \x01(\t\x12\x13\n\x0b\x64\x65scription\x18\x02 \x01(\t\"\x1f\n\x11\x44\x65leteNoteRequest\x12\n\n\x02id\x18\x01 \x01(\t\"\x07\n\x05\x45mpty\"\xcf\x01\n\rMutateRequest\x12\x0b\n\x03tag\x18\x01 \x01(\t\x12-\n\x06\x63reate\x18\x02 \x01(\x0b\x32\x1b.notes.v1.CreateNoteRequestH\x00\x12\x34\n\x06update\x18\x03 \x01(\x0b\x32\".notes.v1.UpdateDescriptionRequestH\x00\x12-\n\x06\x64\x65lete\x18\x04 \x01(\x0b\x32\x1b.notes.v1.DeleteNoteRequestH\x00\x12\x17\n\x0fidempotency_key\x18\x05 \x01(\tB\x04\n\x02op\"\x88\x01\n\x0eMutateResponse\x12\x0b\n\x03tag\x18\x01 \x01(\t\x12\x0c\n\x04\x63ode\x18\x02 \x01(\x05\x12\r\n\x05\x65rror\x18\x03 \x01(\t\x12\x1e\n\x04note\x18\x04 \x01(\x0b\x32\x0e.notes.v1.NoteH\x00\x12\"\n\x07\x64\x65leted\x18\x05 \x01(\x0b\x32\x0f.notes.v1.EmptyH\x00\x42\x08\n\x06result\"\"\n\x11WatchNotesRequest\x12\r\n\x05since\x18\x01 \x01(\x03\"O\n\nNoteChange\x12\x0b\n\x03seq\x18\x01 \x01(\x03\x12\n\n\x02op\x18\x02 \x01(\t\x12\n\n\x02id\x18\x03 \x01(\t\x12\x1c\n\x04note\x18\x04 \x01(\x0b\x32\x0e.notes.v1.Note2\xcd\x03\n\x0cNotesService\x12\x39\n\nCreateNote\x12\x1b.notes.v1.CreateNoteRequest\x1a\x0e.notes.v1.Note\x12\x33\n\x07GetNote\x12\x18.notes.v1.GetNoteRequest\x1a\x0e.notes.v1.Note\x12\x44\n\tListNotes\x12\x1a.notes.v1.ListNotesRequest\x1a\x1b.notes.v1.ListNotesResponse\x12G\n\x11UpdateDescription\x12\".notes.v1.UpdateDescriptionRequest\x1a\x0e.notes.v1.Note\x12:\n\nDeleteNote\x12\x1b.notes.v1.DeleteNoteRequest\x1a\x0f.notes.v1.Empty\x12?\n\x06Mutate\x12\x17.notes.v1.MutateRequest\x1a\x18.notes.v1.MutateResponse(\x01\x30\x01\x12\x41\n\nWatchNotes\x12\x1b.notes.v1.WatchNotesRequest\x1a\x14.notes.v1.NoteChange0\x01\x62\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'notes_pb2', _globals)
 if not _descriptor._USE_C_DESCRIPTORS:
   DESCRIPTOR._loaded_options = None
-  _globals['_NOTE']._serialized_start=25
-  _globals['_NOTE']._serialized_end=110
-  _globals['_CREATENOTEREQUEST']._serialized_start=112
-  _globals['_CREATENOTEREQUEST']._serialized_end=152
-  _globals['_GETNOTEREQUEST']._serialized_start=154
-  _globals['_GETNOTEREQUEST']._serialized_end=182
-  _globals['_LISTNOTESREQUEST']._serialized_start=184
-  _globals['_LISTNOTESREQUEST']._serialized_end=202
-  _globals['_LISTNOTESRESPONSE']._serialized_start=204
-  _globals['_LISTNOTESRESPONSE']._serialized_end=254
-  _globals['_UPDATEDESCRIPTIONREQUEST']._serialized_start=256
-  _globals['_UPDATEDESCRIPTIONREQUEST']._serialized_end=315
-  _globals['_DELETENOTEREQUEST']._serialized_start=317
-  _globals['_DELETENOTEREQUEST']._serialized_end=348
-  _globals['_EMPTY']._serialized_start=350
-  _globals['_EMPTY']._serialized_end=357
-  _globals['_NOTESSERVICE']._serialized_start=360
-  _globals['_NOTESSERVICE']._serialized_end=689
+  _globals['_NOTE']._serialized_start=59
+  _globals['_NOTE']._serialized_end=144
+  _globals['_CREATENOTEREQUEST']._serialized_start=146
+  _globals['_CREATENOTEREQUEST']._serialized_end=186
+  _globals['_GETNOTEREQUEST']._serialized_start=188
+  _globals['_GETNOTEREQUEST']._serialized_end=263
+  _globals['_LISTNOTESREQUEST']._serialized_start=265
+  _globals['_LISTNOTESREQUEST']._serialized_end=330
+  _globals['_LISTNOTESRESPONSE']._serialized_start=332
+  _globals['_LISTNOTESRESPONSE']._serialized_end=382
+  _globals['_UPDATEDESCRIPTIONREQUEST']._serialized_start=384
+  _globals['_UPDATEDESCRIPTIONREQUEST']._serialized_end=443
+  _globals['_DELETENOTEREQUEST']._serialized_start=445
+  _globals['_DELETENOTEREQUEST']._serialized_end=476
+  _globals['_EMPTY']._serialized_start=478
+  _globals['_EMPTY']._serialized_end=485
+  _globals['_MUTATEREQUEST']._serialized_start=488
+  _globals['_MUTATEREQUEST']._serialized_end=695
+  _globals['_MUTATERESPONSE']._serialized_start=698
+  _globals['_MUTATERESPONSE']._serialized_end=834
+  _globals['_WATCHNOTESREQUEST']._serialized_start=836
+  _globals['_WATCHNOTESREQUEST']._serialized_end=870
+  _globals['_NOTECHANGE']._serialized_start=872
+  _globals['_NOTECHANGE']._serialized_end=951
+  _globals['_NOTESSERVICE']._serialized_start=954
+  _globals['_NOTESSERVICE']._serialized_end=1415
 # @@protoc_insertion_point(module_scope)
@@ -59,6 +59,16 @@ class NotesServiceStub(object):
                 request_serializer=notes__pb2.DeleteNoteRequest.SerializeToString,
                 response_deserializer=notes__pb2.Empty.FromString,
                 _registered_method=True)
+        self.Mutate = channel.stream_stream(
+                '/notes.v1.NotesService/Mutate',
+                request_serializer=notes__pb2.MutateRequest.SerializeToString,
+                response_deserializer=notes__pb2.MutateResponse.FromString,
+                _registered_method=True)
+        self.WatchNotes = channel.unary_stream(
+                '/notes.v1.NotesService/WatchNotes',
+                request_serializer=notes__pb2.WatchNotesRequest.SerializeToString,
+                response_deserializer=notes__pb2.NoteChange.FromString,
+                _registered_method=True)
 
 
 class NotesServiceServicer(object):
@@ -94,6 +104,18 @@ class NotesServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def Mutate(self, request_iterator, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def WatchNotes(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_NotesServiceServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -122,6 +144,16 @@ def add_NotesServiceServicer_to_server(servicer, server):
                     request_deserializer=notes__pb2.DeleteNoteRequest.FromString,
                     response_serializer=notes__pb2.Empty.SerializeToString,
             ),
+            'Mutate': grpc.stream_stream_rpc_method_handler(
+                    servicer.Mutate,
+                    request_deserializer=notes__pb2.MutateRequest.FromString,
+                    response_serializer=notes__pb2.MutateResponse.SerializeToString,
+            ),
+            'WatchNotes': grpc.unary_stream_rpc_method_handler(
+                    servicer.WatchNotes,
+                    request_deserializer=notes__pb2.WatchNotesRequest.FromString,
+                    response_serializer=notes__pb2.NoteChange.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'notes.v1.NotesService', rpc_method_handlers)
@@ -267,3 +299,57 @@ class NotesService(object):
             timeout,
             metadata,
             _registered_method=True)
+
+    @staticmethod
+    def Mutate(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_stream(
+            request_iterator,
+            target,
+            '/notes.v1.NotesService/Mutate',
+            notes__pb2.MutateRequest.SerializeToString,
+            notes__pb2.MutateResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def WatchNotes(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/notes.v1.NotesService/WatchNotes',
+            notes__pb2.WatchNotesRequest.SerializeToString,
+            notes__pb2.NoteChange.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
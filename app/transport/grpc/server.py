@@ -8,14 +8,33 @@ from app.transport.grpc.servicer import NotesGrpcServicer
 from app.transport.grpc import notes_pb2_grpc
 
 
+COMPRESSION = {
+    "none": grpc.Compression.NoCompression,
+    "gzip": grpc.Compression.Gzip,
+    "deflate": grpc.Compression.Deflate,
+}
+
+
 def create_grpc_server(service: NotesService) -> grpc.Server:
     workers = int(os.getenv("GRPC_WORKERS", "10"))
     host = os.getenv("GRPC_HOST", "0.0.0.0")
     port = int(os.getenv("GRPC_PORT", "50051"))
+    mutate_max_batch = int(os.getenv("GRPC_MUTATE_MAX_BATCH", "100"))
+    mutate_linger_ms = float(os.getenv("GRPC_MUTATE_LINGER_MS", "2"))
+    # каждый WatchNotes держит поток пула, часть потоков оставляем унарным вызовам
+    watch_max = int(os.getenv("GRPC_WATCH_MAX", str(max(workers // 2, 1))))
+    # так же и каждый поток Mutate; вместе с WatchNotes не больше трёх четвертей пула
+    mutate_max = int(os.getenv("GRPC_MUTATE_MAX", str(max(workers // 4, 1))))
+
+    # сжатие ответов по умолчанию; клиент без поддержки алгоритма получит их несжатыми
+    name = os.getenv("GRPC_COMPRESSION", "gzip").lower()
+    if name not in COMPRESSION:
+        raise ValueError(f"unsupported GRPC_COMPRESSION {name!r}, expected one of: {', '.join(COMPRESSION)}")
+    compression = COMPRESSION[name]
 
-    server = grpc.server(ThreadPoolExecutor(max_workers=workers))
+    server = grpc.server(ThreadPoolExecutor(max_workers=workers), compression=compression)
     notes_pb2_grpc.add_NotesServiceServicer_to_server(
-        NotesGrpcServicer(service), server
+        NotesGrpcServicer(service, mutate_max_batch, mutate_linger_ms / 1000, watch_max, mutate_max), server
     )
     server.add_insecure_port(f"{host}:{port}")
     return server
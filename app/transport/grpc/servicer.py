@@ -1,17 +1,38 @@
+import functools
+import logging
+import queue
+import threading
+import time
+from uuid import uuid4
+
 import grpc
-from app.core.models import Note
-from app.core.errors import ValidationError, StorageUnavailable, NoteNotFound
-from app.core.service import NotesService
+from app.core.models import Mutation, Note
+from app.core.context import RequestContext, request_scope
+from app.core.errors import (
+    ValidationError, StorageUnavailable, NoteNotFound, Overloaded, DeadlineExceeded, ChangeFeedDisabled, ResumeExpired,
+)
+from app.core.service import NotesService, parse_fields
 
 from app.transport.grpc import notes_pb2, notes_pb2_grpc
 
+log = logging.getLogger(__name__)
+
 
 def _dt_to_ms(dt) -> int:
     # datetime -> epoch milliseconds
     return int(dt.timestamp() * 1000)
 
 
-def _note_to_proto(note) -> notes_pb2.Note:
+def _note_to_proto(note, fields=None) -> notes_pb2.Note:
+    if fields is not None:
+        message = notes_pb2.Note(id=note.id)
+        if "description" in fields:
+            message.description = note.description
+        if "created_at" in fields:
+            message.created_at_ms = _dt_to_ms(note.created_at)
+        if "updated_at" in fields:
+            message.updated_at_ms = _dt_to_ms(note.updated_at)
+        return message
     return notes_pb2.Note(
         id=note.id,
         description=note.description,
@@ -20,15 +41,145 @@ def _note_to_proto(note) -> notes_pb2.Note:
     )
 
 
+# пути FieldMask (имена полей Note в proto) -> поля заметки
+_MASK_FIELDS = {"id": "id", "description": "description", "created_at_ms": "created_at", "updated_at_ms": "updated_at"}
+
+
+def _read_mask_fields(request):
+    unknown = [p for p in request.read_mask.paths if p not in _MASK_FIELDS]
+    if unknown:
+        raise ValidationError(f"unknown fields: {', '.join(unknown)}")
+    return parse_fields([_MASK_FIELDS[p] for p in request.read_mask.paths])
+
+
+def _change_to_proto(change) -> notes_pb2.NoteChange:
+    message = notes_pb2.NoteChange(seq=change.seq, op=change.op, id=change.note_id)
+    if change.note is not None:
+        message.note.CopyFrom(_note_to_proto(change.note))
+    return message
+
+
+def _storage_status(e: StorageUnavailable) -> grpc.StatusCode:
+    if isinstance(e, Overloaded):
+        return grpc.StatusCode.RESOURCE_EXHAUSTED
+    if isinstance(e, DeadlineExceeded):
+        return grpc.StatusCode.DEADLINE_EXCEEDED
+    return grpc.StatusCode.UNAVAILABLE
+
+
+MIN_LSN_KEY = "x-min-lsn"
+LSN_KEY = "x-lsn"
+IDEMPOTENCY_KEY = "idempotency-key"
+TRACE_KEY = "x-trace-id"
+SERVER_TIMING_KEY = "server-timing"
+
+
+def _request_context(context: grpc.ServicerContext) -> RequestContext:
+    ctx = RequestContext()
+    for key, value in context.invocation_metadata():
+        if key == MIN_LSN_KEY:
+            ctx.min_lsn = value
+        elif key == IDEMPOTENCY_KEY:
+            ctx.idempotency_key = value
+        elif key == TRACE_KEY:
+            ctx.trace_id = value
+    if ctx.trace_id is None:
+        ctx.trace_id = uuid4().hex
+    rem = context.time_remaining()
+    # без дедлайна gRPC возвращает огромное значение
+    if rem is not None and rem < 86400:
+        ctx.deadline = time.monotonic() + rem
+    # срабатывает при завершении RPC, в т.ч. при отмене клиентом:
+    # ещё не начатая работа в хранилище уже не выполнится
+    context.add_callback(ctx.cancel)
+    return ctx
+
+
+def _in_request_scope(handler):
+    @functools.wraps(handler)
+    def wrapper(self, request, context):
+        ctx = _request_context(context)
+        try:
+            with request_scope(ctx):
+                return handler(self, request, context)
+        finally:
+            # и при abort: ошибка тоже приходит с разбивкой по времени
+            _set_trailing_metadata(context, ctx)
+    return wrapper
+
+
+def _set_trailing_metadata(context: grpc.ServicerContext, ctx: RequestContext):
+    metadata = [(TRACE_KEY, ctx.trace_id), (SERVER_TIMING_KEY, ctx.server_timing())]
+    if ctx.lsn:
+        metadata.append((LSN_KEY, ctx.lsn))
+    context.set_trailing_metadata(tuple(metadata))
+
+
+_EOF = object()
+
+
+def _pump(request_iterator, incoming: queue.Queue):
+    # читаем входящий поток в отдельном потоке, чтобы собирать пачки по таймауту
+    try:
+        for request in request_iterator:
+            incoming.put(request)
+    except Exception:
+        pass
+    finally:
+        incoming.put(_EOF)
+
+
+def _to_mutation(request) -> Mutation:
+    op = request.WhichOneof("op")
+    key = request.idempotency_key or None
+    if op == "create":
+        return Mutation(op="create", description=request.create.description, idempotency_key=key)
+    if op == "update":
+        return Mutation(
+            op="update", note_id=request.update.id, description=request.update.description, idempotency_key=key
+        )
+    if op == "delete":
+        return Mutation(op="delete", note_id=request.delete.id, idempotency_key=key)
+    return Mutation(op="")
+
+
+def _mutate_error(tag: str, code: grpc.StatusCode, message: str) -> notes_pb2.MutateResponse:
+    return notes_pb2.MutateResponse(tag=tag, code=code.value[0], error=message)
+
+
+def _mutate_response(tag: str, result) -> notes_pb2.MutateResponse:
+    if isinstance(result, Note):
+        return notes_pb2.MutateResponse(tag=tag, note=_note_to_proto(result))
+    if result is None:
+        return notes_pb2.MutateResponse(tag=tag, deleted=notes_pb2.Empty())
+    if isinstance(result, NoteNotFound):
+        return _mutate_error(tag, grpc.StatusCode.NOT_FOUND, "note not found")
+    if isinstance(result, ValidationError):
+        return _mutate_error(tag, grpc.StatusCode.INVALID_ARGUMENT, str(result))
+    return _mutate_error(tag, grpc.StatusCode.INTERNAL, "internal error")
+
+
 class NotesGrpcServicer(notes_pb2_grpc.NotesServiceServicer):
-    def __init__(self, service: NotesService):
+    def __init__(
+        self,
+        service: NotesService,
+        mutate_max_batch: int = 100,
+        mutate_linger_sec: float = 0.002,
+        watch_max: int = 5,
+        mutate_max: int = 2,
+    ):
         self._service = service
+        self._mutate_max_batch = mutate_max_batch
+        self._mutate_linger_sec = mutate_linger_sec
+        self._watch_slots = threading.BoundedSemaphore(watch_max)
+        self._mutate_slots = threading.BoundedSemaphore(mutate_max)
 
     def _check_deadline(self, context: grpc.ServicerContext):
         rem = context.time_remaining()
         if rem is not None and rem <= 0:
             context.abort(grpc.StatusCode.DEADLINE_EXCEEDED, "deadline exceeded")
 
+    @_in_request_scope
     def CreateNote(self, request, context):
         self._check_deadline(context)
         try:
@@ -36,33 +187,44 @@ class NotesGrpcServicer(notes_pb2_grpc.NotesServiceServicer):
             return _note_to_proto(note)
         except ValidationError as e:
             context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+        except NoteNotFound:
+            context.abort(grpc.StatusCode.NOT_FOUND, "note not found")
         except StorageUnavailable as e:
-            context.abort(grpc.StatusCode.UNAVAILABLE, str(e))
+            context.abort(_storage_status(e), str(e))
         except Exception:
             context.abort(grpc.StatusCode.INTERNAL, "internal error")
 
+    @_in_request_scope
     def GetNote(self, request, context):
         self._check_deadline(context)
         try:
-            note = self._service.get(request.id)
-            return _note_to_proto(note)
+            fields = _read_mask_fields(request)
+            note = self._service.get(request.id, fields)
+            return _note_to_proto(note, fields)
+        except ValidationError as e:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
         except NoteNotFound:
             context.abort(grpc.StatusCode.NOT_FOUND, "note not found")
         except StorageUnavailable as e:
-            context.abort(grpc.StatusCode.UNAVAILABLE, str(e))
+            context.abort(_storage_status(e), str(e))
         except Exception:
             context.abort(grpc.StatusCode.INTERNAL, "internal error")
 
+    @_in_request_scope
     def ListNotes(self, request, context):
         self._check_deadline(context)
         try:
-            notes = self._service.list()
-            return notes_pb2.ListNotesResponse(notes=[_note_to_proto(n) for n in notes])
+            fields = _read_mask_fields(request)
+            notes = self._service.list(fields)
+            return notes_pb2.ListNotesResponse(notes=[_note_to_proto(n, fields) for n in notes])
+        except ValidationError as e:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
         except StorageUnavailable as e:
-            context.abort(grpc.StatusCode.UNAVAILABLE, str(e))
+            context.abort(_storage_status(e), str(e))
         except Exception:
             context.abort(grpc.StatusCode.INTERNAL, "internal error")
 
+    @_in_request_scope
     def UpdateDescription(self, request, context):
         self._check_deadline(context)
         try:
@@ -73,18 +235,107 @@ class NotesGrpcServicer(notes_pb2_grpc.NotesServiceServicer):
         except NoteNotFound:
             context.abort(grpc.StatusCode.NOT_FOUND, "note not found")
         except StorageUnavailable as e:
-            context.abort(grpc.StatusCode.UNAVAILABLE, str(e))
+            context.abort(_storage_status(e), str(e))
         except Exception:
             context.abort(grpc.StatusCode.INTERNAL, "internal error")
 
+    @_in_request_scope
     def DeleteNote(self, request, context):
         self._check_deadline(context)
         try:
             self._service.delete(request.id)
             return notes_pb2.Empty()
+        except ValidationError as e:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
         except NoteNotFound:
             context.abort(grpc.StatusCode.NOT_FOUND, "note not found")
         except StorageUnavailable as e:
-            context.abort(grpc.StatusCode.UNAVAILABLE, str(e))
+            context.abort(_storage_status(e), str(e))
         except Exception:
             context.abort(grpc.StatusCode.INTERNAL, "internal error")
+
+    def Mutate(self, request_iterator, context):
+        self._check_deadline(context)
+        # поток Mutate держит поток пула gRPC (и поток чтения) всё время жизни,
+        # часть пула должна оставаться унарным вызовам
+        if not self._mutate_slots.acquire(blocking=False):
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, "too many mutate streams")
+        ctx = _request_context(context)
+        ctx.idempotency_key = None
+        try:
+            yield from self._mutate(request_iterator, context, ctx)
+        finally:
+            self._mutate_slots.release()
+            _set_trailing_metadata(context, ctx)
+
+    def _mutate(self, request_iterator, context, ctx: RequestContext):
+        incoming = queue.Queue()
+        threading.Thread(target=_pump, args=(request_iterator, incoming), daemon=True).start()
+
+        finished = False
+        while not finished:
+            request = self._receive(incoming, ctx, context)
+            if request is _EOF:
+                break
+
+            # добираем операции, пришедшие почти одновременно, в одну пачку
+            batch = [request]
+            linger_until = time.monotonic() + self._mutate_linger_sec
+            while len(batch) < self._mutate_max_batch:
+                try:
+                    request = incoming.get(timeout=max(linger_until - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if request is _EOF:
+                    finished = True
+                    break
+                batch.append(request)
+
+            # дедлайн вызова проверяем на каждой пачке, а не только при открытии потока
+            self._check_deadline(context)
+            with request_scope(ctx):
+                responses = self._apply_mutations(batch)
+            yield from responses
+
+    def _receive(self, incoming: queue.Queue, ctx: RequestContext, context: grpc.ServicerContext):
+        # простаивающий поток ждёт следующего сообщения не дольше своего дедлайна
+        rem = ctx.remaining()
+        try:
+            return incoming.get(timeout=None if rem is None else max(rem, 0))
+        except queue.Empty:
+            context.abort(grpc.StatusCode.DEADLINE_EXCEEDED, "deadline exceeded")
+
+    def _apply_mutations(self, batch):
+        try:
+            results = self._service.mutate([_to_mutation(r) for r in batch])
+        except StorageUnavailable as e:
+            return [_mutate_error(r.tag, _storage_status(e), str(e)) for r in batch]
+        except Exception:
+            return [_mutate_error(r.tag, grpc.StatusCode.INTERNAL, "internal error") for r in batch]
+        return [_mutate_response(r.tag, result) for r, result in zip(batch, results)]
+
+    def WatchNotes(self, request, context):
+        if not self._watch_slots.acquire(blocking=False):
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, "too many watchers")
+        try:
+            try:
+                subscription = self._service.subscribe(request.since)
+            except ChangeFeedDisabled as e:
+                context.abort(grpc.StatusCode.UNIMPLEMENTED, str(e))
+            except ResumeExpired as e:
+                # клиент должен перечитать заметки целиком и подписаться с since = 0
+                context.abort(grpc.StatusCode.OUT_OF_RANGE, str(e))
+            except StorageUnavailable as e:
+                context.abort(_storage_status(e), str(e))
+
+            try:
+                while context.is_active():
+                    for change in subscription.next(timeout=1.0):
+                        yield _change_to_proto(change)
+            except Exception:
+                log.exception("WatchNotes failed")
+                context.abort(grpc.StatusCode.UNAVAILABLE, "change feed is unavailable")
+            finally:
+                subscription.close()
+        finally:
+            self._watch_slots.release()
@@ -0,0 +1,53 @@
+import time
+from uuid import uuid4
+
+from app.core.context import RequestContext, request_scope
+
+# Оставшийся бюджет запроса в миллисекундах; выставляет LB на каждую попытку.
+DEADLINE_HEADER = b"x-request-deadline-ms"
+# read-your-writes: X-LSN приходит в ответе на запись, клиент возвращает его в X-Min-LSN
+MIN_LSN_HEADER = b"x-min-lsn"
+LSN_HEADER = b"x-lsn"
+# повтор записи с тем же ключом не выполняется заново (LB проставляет ключ, если его нет)
+IDEMPOTENCY_HEADER = b"idempotency-key"
+# id трассы от LB (или свой); в ответе вместе с Server-Timing по участкам запроса
+TRACE_HEADER = b"x-trace-id"
+SERVER_TIMING_HEADER = b"server-timing"
+
+
+class RequestContextMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        ctx = RequestContext()
+        headers = dict(scope["headers"])
+        raw_deadline = headers.get(DEADLINE_HEADER)
+        if raw_deadline:
+            try:
+                ctx.deadline = time.monotonic() + float(raw_deadline) / 1000
+            except ValueError:
+                pass
+        raw_lsn = headers.get(MIN_LSN_HEADER)
+        if raw_lsn:
+            ctx.min_lsn = raw_lsn.decode("latin-1")
+        raw_key = headers.get(IDEMPOTENCY_HEADER)
+        if raw_key:
+            ctx.idempotency_key = raw_key.decode("latin-1")
+        raw_trace = headers.get(TRACE_HEADER)
+        ctx.trace_id = raw_trace.decode("latin-1") if raw_trace else uuid4().hex
+
+        async def send_with_context(message):
+            if message["type"] == "http.response.start":
+                message = dict(message)
+                extra = [(TRACE_HEADER, ctx.trace_id.encode()), (SERVER_TIMING_HEADER, ctx.server_timing().encode())]
+                if ctx.lsn:
+                    extra.append((LSN_HEADER, ctx.lsn.encode()))
+                message["headers"] = list(message.get("headers", [])) + extra
+            await send(message)
+
+        with request_scope(ctx):
+            await self.app(scope, receive, send_with_context)
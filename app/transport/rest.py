@@ -1,24 +1,48 @@
-from fastapi import FastAPI, HTTPException
-from sqlalchemy import text
-from app.db import SessionLocal
-from app.core.errors import ValidationError, StorageUnavailable, NoteNotFound
+import hmac
+import json
+import os
+import time
+from typing import Optional
+
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from app.db import engine
+from app import db_pool
+from app.core.errors import (
+    ValidationError, StorageUnavailable, NoteNotFound, Overloaded, DeadlineExceeded, ChangeFeedDisabled, ResumeExpired,
+    IdempotencyConflict,
+)
 from app.core.models import Note
-from app.core.service import NotesService
-from app.main import storage
+from app.core.service import NotesService, parse_fields
+from app.main import changes, partitions, storage
+from app import profiler
 
 from app.transport.grpc.server import create_grpc_server
 from starlette.middleware.wsgi import WSGIMiddleware
 from app.transport.soap_app import build_soap_wsgi_app
+from app.transport.soap_fast import FastSoapAsgi, FastSoapWsgi
+from app.transport.middleware import RequestContextMiddleware
+from app.transport.compression import CompressionMiddleware
 
 
 
 app = FastAPI()
+app.add_middleware(RequestContextMiddleware)
+app.add_middleware(CompressionMiddleware)
 
 grpc_server = None
 
 @app.on_event("startup")
 def _startup():
     global grpc_server
+    for monitor in db_pool.monitors():
+        monitor.start()
+    if changes is not None:
+        changes.start()
+    for manager in partitions:
+        manager.start()
     grpc_server = create_grpc_server(service)
     grpc_server.start()
 
@@ -27,21 +51,73 @@ def _shutdown():
     global grpc_server
     if grpc_server is not None:
         grpc_server.stop(grace=0.5)
+    if changes is not None:
+        changes.stop()
+    for manager in partitions:
+        manager.stop()
+    for monitor in db_pool.monitors():
+        monitor.stop()
 
 
 
-service = NotesService(repo=storage)
+service = NotesService(repo=storage, changes=changes)
 soap_wsgi = build_soap_wsgi_app(service)
-app.mount("/soap", WSGIMiddleware(soap_wsgi))
+if os.getenv("SOAP_FAST_PATH", "1") == "1":
+    # WSGI-часть остаётся для WSDL (с кэшем) и всего, что не попало в быстрый путь
+    app.mount("/soap", FastSoapAsgi(service, WSGIMiddleware(FastSoapWsgi(service, soap_wsgi))))
+else:
+    app.mount("/soap", WSGIMiddleware(soap_wsgi))
+
+def _invalid(e: ValidationError) -> HTTPException:
+    # тот же ключ идемпотентности с другим запросом - 422, остальные ошибки валидации - 400
+    return HTTPException(status_code=422 if isinstance(e, IdempotencyConflict) else 400, detail=str(e))
+
+
+def _unavailable(e: StorageUnavailable) -> HTTPException:
+    if isinstance(e, Overloaded):
+        # Retry-After: LB повторит на другом экземпляре, не открывая circuit breaker
+        return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    if isinstance(e, DeadlineExceeded):
+        return HTTPException(status_code=504, detail=str(e))
+    return HTTPException(status_code=503, detail=str(e))
+
 
 @app.get("/health")
 def health():
-    try:
-        with SessionLocal() as session:
-            session.execute(text("SELECT 1"))
+    # результат фоновой проверки пула, без запроса к БД на каждую пробу LB
+    if db_pool.monitor_for(engine).healthy():
         return {"status": "OK"}
-    except Exception:
-        raise HTTPException(status_code=503, detail="database unavailable")
+    raise HTTPException(status_code=503, detail="database unavailable")
+
+
+@app.get("/stats")
+def stats():
+    return {
+        "service": service.stats(),
+        "db_pool": {m.name: m.stats() for m in db_pool.monitors()},
+    }
+
+
+# без ADMIN_TOKEN админские ручки выключены
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+
+def _check_admin(token: Optional[str]):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not token or not hmac.compare_digest(token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="forbidden")
+
+
+@app.post("/admin/profile", response_class=PlainTextResponse)
+async def profile(seconds: float = 10, x_admin_token: Optional[str] = Header(None)):
+    # профиль одного экземпляра, вызывать напрямую (app1:8000), а не через LB с его бюджетом в 2 с
+    _check_admin(x_admin_token)
+    try:
+        stacks = await run_in_threadpool(profiler.sample, seconds)
+    except profiler.ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return PlainTextResponse(profiler.collapsed(stacks))
 
 
 @app.post("/notes")
@@ -49,26 +125,95 @@ def create_note(description: str):
     try:
         return service.create(description)
     except ValidationError as e:
-        raise HTTPException(status_code=400, detail=str(e))
+        raise _invalid(e)
+    except NoteNotFound:
+        raise HTTPException(status_code=404, detail="note not found")
     except StorageUnavailable as e:
-        raise HTTPException(status_code=503, detail=str(e))
+        raise _unavailable(e)
+
+
+def _parse_fields(fields: Optional[str]):
+    # ?fields=id,updated_at -> в ответе только эти поля (и id)
+    if fields is None:
+        return None
+    return parse_fields([f.strip() for f in fields.split(",") if f.strip()])
+
+
+def _project(note: Note, fields):
+    if fields is None:
+        return note
+    return {f: getattr(note, f) for f in fields}
 
 
 @app.get("/notes")
-def list_notes():
+def list_notes(fields: Optional[str] = None):
     try:
-        return service.list()
+        fields = _parse_fields(fields)
+        return [_project(n, fields) for n in service.list(fields)]
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except StorageUnavailable as e:
-        raise HTTPException(status_code=503, detail=str(e))
+        raise _unavailable(e)
+
+SSE_HEARTBEAT_SEC = 15.0
+
+
+def _sse_event(change) -> str:
+    data = json.dumps(jsonable_encoder({"seq": change.seq, "op": change.op, "id": change.note_id, "note": change.note}))
+    return f"id: {change.seq}\nevent: {change.op}\ndata: {data}\n\n"
+
+
+# объявлен до /notes/{note_id}, иначе "changes" примется за id
+@app.get("/notes/changes")
+async def watch_notes(request: Request, since: int = 0, last_event_id: Optional[str] = Header(None)):
+    # при переподключении EventSource сам присылает Last-Event-ID
+    if last_event_id:
+        try:
+            since = int(last_event_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="invalid Last-Event-ID")
+    try:
+        subscription = await service.asubscribe(since)
+    except ChangeFeedDisabled as e:
+        raise HTTPException(status_code=501, detail=str(e))
+    except ResumeExpired as e:
+        raise HTTPException(status_code=410, detail=str(e))
+    except StorageUnavailable as e:
+        raise _unavailable(e)
+
+    async def events():
+        try:
+            last_sent = time.monotonic()
+            while not await request.is_disconnected():
+                batch = await subscription.next(timeout=1.0)
+                if batch:
+                    yield "".join(_sse_event(c) for c in batch)
+                    last_sent = time.monotonic()
+                elif time.monotonic() - last_sent >= SSE_HEARTBEAT_SEC:
+                    # комментарий SSE: не даёт прокси закрыть простаивающее соединение
+                    yield ": ping\n\n"
+                    last_sent = time.monotonic()
+        finally:
+            subscription.close()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 
 @app.get("/notes/{note_id}")
-def get_note(note_id: str):
+def get_note(note_id: str, fields: Optional[str] = None):
     try:
-        return service.get(note_id)
+        fields = _parse_fields(fields)
+        return _project(service.get(note_id, fields), fields)
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except NoteNotFound:
         raise HTTPException(status_code=404, detail="note not found")
     except StorageUnavailable as e:
-        raise HTTPException(status_code=503, detail=str(e))
+        raise _unavailable(e)
 
 @app.patch("/notes/{note_id}")
 def update_note(note_id: str, description: str):
@@ -77,9 +222,9 @@ def update_note(note_id: str, description: str):
     except NoteNotFound:
         raise HTTPException(status_code=404, detail="note not found")
     except ValidationError as e:
-        raise HTTPException(status_code=400, detail=str(e))
+        raise _invalid(e)
     except StorageUnavailable as e:
-        raise HTTPException(status_code=503, detail=str(e))
+        raise _unavailable(e)
 
 @app.delete("/notes/{note_id}", status_code=204)
 def delete_note(note_id: str):
@@ -87,5 +232,7 @@ def delete_note(note_id: str):
         service.delete(note_id)
     except NoteNotFound:
         raise HTTPException(status_code=404, detail="note not found")
+    except ValidationError as e:
+        raise _invalid(e)
     except StorageUnavailable as e:
-        raise HTTPException(status_code=503, detail=str(e))
+        raise _unavailable(e)
@@ -6,8 +6,9 @@ from spyne.protocol.soap import Soap11
 from spyne.server.wsgi import WsgiApplication
 from spyne.error import Fault
 
+from app.core.context import current
 from app.core.errors import ValidationError, StorageUnavailable, NoteNotFound
-from app.core.service import NotesService
+from app.core.service import NotesService, parse_fields
 
 
 def _dt_to_ms(dt: datetime) -> int:
@@ -21,11 +22,47 @@ class NoteSoap(ComplexModel):
     updated_at_ms = Integer
 
 
+# необязательный параметр fields у GetNote / ListNotes: "id,updated_at_ms" -> только эти элементы NoteSoap
+_SOAP_FIELDS = {"id": "id", "description": "description", "created_at_ms": "created_at", "updated_at_ms": "updated_at"}
+
+
+def parse_soap_fields(raw):
+    names = [f.strip() for f in (raw or "").split(",") if f.strip()]
+    unknown = [n for n in names if n not in _SOAP_FIELDS]
+    if unknown:
+        raise ValidationError(f"unknown fields: {', '.join(unknown)}")
+    return parse_fields([_SOAP_FIELDS[n] for n in names])
+
+
+def _note_to_soap(note, fields) -> NoteSoap:
+    # незапрошенные элементы не выводятся (None)
+    return NoteSoap(
+        id=note.id,
+        description=note.description if fields is None or "description" in fields else None,
+        created_at_ms=_dt_to_ms(note.created_at) if fields is None or "created_at" in fields else None,
+        updated_at_ms=_dt_to_ms(note.updated_at) if fields is None or "updated_at" in fields else None,
+    )
+
+
+class IdempotencyKey(ComplexModel):
+    # <soap:Header><tns:IdempotencyKey><tns:key>...</tns:key></tns:IdempotencyKey></soap:Header>
+    __namespace__ = "notes.soap"
+    key = Unicode
+
+
+def _use_idempotency_key(ctx):
+    # ключ из SOAP-заголовка важнее HTTP-заголовка Idempotency-Key
+    if ctx.in_header is not None and ctx.in_header.key:
+        current().idempotency_key = ctx.in_header.key
+
+
 def build_soap_wsgi_app(service: NotesService) -> WsgiApplication:
     class NotesSoapService(ServiceBase):
+        __in_header__ = IdempotencyKey
 
         @rpc(Unicode, _returns=NoteSoap)
         def CreateNote(ctx, description):
+            _use_idempotency_key(ctx)
             try:
                 note = service.create(description)
                 return NoteSoap(
@@ -36,40 +73,38 @@ def build_soap_wsgi_app(service: NotesService) -> WsgiApplication:
                 )
             except ValidationError as e:
                 raise Fault(faultcode="Client", faultstring=str(e))
+            except NoteNotFound:
+                raise Fault(faultcode="Client", faultstring="note not found")
             except StorageUnavailable as e:
                 raise Fault(faultcode="Server", faultstring=str(e))
 
-        @rpc(Unicode, _returns=NoteSoap)
-        def GetNote(ctx, note_id):
+        @rpc(Unicode, Unicode, _returns=NoteSoap)
+        def GetNote(ctx, note_id, fields):
             try:
-                note = service.get(note_id)
-                return NoteSoap(
-                    id=note.id,
-                    description=note.description,
-                    created_at_ms=_dt_to_ms(note.created_at),
-                    updated_at_ms=_dt_to_ms(note.updated_at),
-                )
+                fields = parse_soap_fields(fields)
+                return _note_to_soap(service.get(note_id, fields), fields)
+            except ValidationError as e:
+                raise Fault(faultcode="Client", faultstring=str(e))
             except NoteNotFound:
                 raise Fault(faultcode="Client", faultstring="note not found")
             except StorageUnavailable as e:
                 raise Fault(faultcode="Server", faultstring=str(e))
 
-        @rpc(_returns=Iterable(NoteSoap))
-        def ListNotes(ctx):
+        @rpc(Unicode, _returns=Iterable(NoteSoap))
+        def ListNotes(ctx, fields):
+            # не генератор: Fault из генератора Spyne не превращает в ответ
             try:
-                notes = service.list()
-                for note in notes:
-                    yield NoteSoap(
-                        id=note.id,
-                        description=note.description,
-                        created_at_ms=_dt_to_ms(note.created_at),
-                        updated_at_ms=_dt_to_ms(note.updated_at),
-                    )
+                fields = parse_soap_fields(fields)
+                notes = service.list(fields)
+            except ValidationError as e:
+                raise Fault(faultcode="Client", faultstring=str(e))
             except StorageUnavailable as e:
                 raise Fault(faultcode="Server", faultstring=str(e))
+            return [_note_to_soap(note, fields) for note in notes]
 
         @rpc(Unicode, Unicode, _returns=NoteSoap)
         def UpdateDescription(ctx, note_id, description):
+            _use_idempotency_key(ctx)
             try:
                 note = service.update(note_id, description)
                 return NoteSoap(
@@ -87,9 +122,12 @@ def build_soap_wsgi_app(service: NotesService) -> WsgiApplication:
 
         @rpc(Unicode, _returns=Unicode)
         def DeleteNote(ctx, note_id):
+            _use_idempotency_key(ctx)
             try:
                 service.delete(note_id)
                 return "OK"
+            except ValidationError as e:
+                raise Fault(faultcode="Client", faultstring=str(e))
             except NoteNotFound:
                 raise Fault(faultcode="Client", faultstring="note not found")
             except StorageUnavailable as e:
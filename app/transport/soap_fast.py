@@ -0,0 +1,409 @@
+import io
+import itertools
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+from wsgiref.util import request_uri
+from xml.sax.saxutils import escape
+
+import anyio
+from lxml import etree
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response, StreamingResponse
+
+from app.core.context import current
+from app.core.errors import ValidationError, StorageUnavailable, NoteNotFound
+from app.core.service import NotesService
+from app.transport.soap_app import NoteSoap, _dt_to_ms, parse_soap_fields
+
+# Быстрый путь для пяти операций Notes: разбор через iterparse и ответы по шаблонам.
+# Всё, что не распознано однозначно, уходит в Spyne без изменений.
+
+log = logging.getLogger(__name__)
+
+SOAP_ENV_NS = "http://schemas.xmlsoap.org/soap/envelope/"
+TNS = "notes.soap"
+
+FAST_OPERATIONS: Dict[str, Tuple[str, ...]] = {
+    "CreateNote": ("description",),
+    "GetNote": ("note_id",),
+    "ListNotes": (),
+    "UpdateDescription": ("note_id", "description"),
+    "DeleteNote": ("note_id",),
+}
+# необязательные параметры
+FAST_OPTIONAL: Dict[str, Tuple[str, ...]] = {
+    "GetNote": ("fields",),
+    "ListNotes": ("fields",),
+}
+
+_XML_DECL = b"<?xml version='1.0' encoding='UTF-8'?>\n"
+# Spyne выводит namespace типа из имени модуля, где объявлен NoteSoap
+_ENVELOPE = (
+    f'<soap11env:Envelope xmlns:soap11env="{SOAP_ENV_NS}" xmlns:tns="{TNS}" '
+    f'xmlns:s0="{NoteSoap.__module__}"><soap11env:Body>'
+).encode()
+_ENVELOPE_NO_S0 = f'<soap11env:Envelope xmlns:soap11env="{SOAP_ENV_NS}" xmlns:tns="{TNS}"><soap11env:Body>'.encode()
+_ENVELOPE_FAULT = f'<soap11env:Envelope xmlns:soap11env="{SOAP_ENV_NS}"><soap11env:Body>'.encode()
+_ENVELOPE_END = b"</soap11env:Body></soap11env:Envelope>"
+
+_NOTE_FIELDS = (
+    "<s0:id>{id}</s0:id><s0:description>{description}</s0:description>"
+    "<s0:created_at_ms>{created_at_ms}</s0:created_at_ms><s0:updated_at_ms>{updated_at_ms}</s0:updated_at_ms>"
+)
+_FAULT = (
+    "<soap11env:Fault><faultcode>soap11env:{code}</faultcode>"
+    "<faultstring>{message}</faultstring><faultactor></faultactor></soap11env:Fault>"
+)
+
+_ENVELOPE_TAG = f"{{{SOAP_ENV_NS}}}Envelope"
+_HEADER_TAG = f"{{{SOAP_ENV_NS}}}Header"
+_BODY_TAG = f"{{{SOAP_ENV_NS}}}Body"
+_IDEMPOTENCY_TAG = f"{{{TNS}}}IdempotencyKey"
+_IDEMPOTENCY_KEY_TAG = f"{{{TNS}}}key"
+
+
+def parse_request(body: bytes) -> Optional[Tuple[str, Dict[str, str]]]:
+    # None -> запрос не для быстрого пути (или невалиден), его разберёт Spyne;
+    # ключ идемпотентности из заголовка возвращается в params["idempotency_key"]
+    op = None
+    key = None
+    expected: Tuple[str, ...] = ()
+    optional: Tuple[str, ...] = ()
+    params: Dict[str, str] = {}
+    path = []
+    try:
+        for event, el in etree.iterparse(
+            io.BytesIO(body), events=("start", "end"), resolve_entities=False, no_network=True
+        ):
+            if event == "start":
+                path.append(el.tag)
+                depth = len(path)
+                if depth == 1 and el.tag != _ENVELOPE_TAG:
+                    return None
+                if depth == 2 and el.tag not in (_HEADER_TAG, _BODY_TAG):
+                    return None
+                if depth > 2 and path[1] == _HEADER_TAG:
+                    continue
+                if depth == 3:
+                    if op is not None or not el.tag.startswith(f"{{{TNS}}}"):
+                        return None
+                    op = el.tag[len(TNS) + 2:]
+                    if op not in FAST_OPERATIONS:
+                        return None
+                    expected = FAST_OPERATIONS[op]
+                    optional = FAST_OPTIONAL.get(op, ())
+                if depth == 4:
+                    name = el.tag[len(TNS) + 2:] if el.tag.startswith(f"{{{TNS}}}") else None
+                    if (name not in expected and name not in optional) or name in params or el.attrib:
+                        return None
+                if depth > 4:
+                    return None
+                continue
+
+            depth = len(path)
+            path.pop()
+            # el.text - только текст до первого дочернего узла; комментарии и PI внутри значения
+            # (событий start у них нет) оставляем Spyne, который склеивает текст вокруг них
+            if depth == 4 and path[1] == _HEADER_TAG and path[2] == _IDEMPOTENCY_TAG and el.tag == _IDEMPOTENCY_KEY_TAG:
+                if len(el):
+                    return None
+                key = el.text
+            if depth == 4 and path[1] == _BODY_TAG:
+                if el.text is None or len(el):
+                    return None
+                params[el.tag[len(TNS) + 2:]] = el.text
+            if depth >= 3:
+                el.clear()
+    except etree.XMLSyntaxError:
+        return None
+
+    if op is None or not set(expected) <= set(params) <= set(expected + optional):
+        return None
+    if key:
+        params["idempotency_key"] = key
+    return op, params
+
+
+def _note_xml(note, fields=None) -> str:
+    if fields is None:
+        return _NOTE_FIELDS.format(
+            id=escape(note.id),
+            description=escape(note.description),
+            created_at_ms=_dt_to_ms(note.created_at),
+            updated_at_ms=_dt_to_ms(note.updated_at),
+        )
+    # как у Spyne: незапрошенных элементов нет совсем
+    parts = [f"<s0:id>{escape(note.id)}</s0:id>"]
+    if "description" in fields:
+        parts.append(f"<s0:description>{escape(note.description)}</s0:description>")
+    if "created_at" in fields:
+        parts.append(f"<s0:created_at_ms>{_dt_to_ms(note.created_at)}</s0:created_at_ms>")
+    if "updated_at" in fields:
+        parts.append(f"<s0:updated_at_ms>{_dt_to_ms(note.updated_at)}</s0:updated_at_ms>")
+    return "".join(parts)
+
+
+def render_note(op: str, note, fields=None) -> bytes:
+    body = _note_xml(note, fields)
+    return b"".join((
+        _XML_DECL, _ENVELOPE,
+        f"<tns:{op}Response><tns:{op}Result>{body}</tns:{op}Result></tns:{op}Response>".encode(),
+        _ENVELOPE_END,
+    ))
+
+
+def render_deleted() -> bytes:
+    return b"".join((
+        _XML_DECL, _ENVELOPE_NO_S0,
+        b"<tns:DeleteNoteResponse><tns:DeleteNoteResult>OK</tns:DeleteNoteResult></tns:DeleteNoteResponse>",
+        _ENVELOPE_END,
+    ))
+
+
+def render_list_item(note, fields=None) -> bytes:
+    return b"".join((b"<s0:NoteSoap>", _note_xml(note, fields).encode(), b"</s0:NoteSoap>"))
+
+
+_LIST_HEAD = _XML_DECL + _ENVELOPE + b"<tns:ListNotesResponse><tns:ListNotesResult>"
+_LIST_TAIL = b"</tns:ListNotesResult></tns:ListNotesResponse>" + _ENVELOPE_END
+
+
+def render_list(notes: Iterable, fields=None) -> Iterable[bytes]:
+    yield _LIST_HEAD
+    for note in notes:
+        yield render_list_item(note, fields)
+    yield _LIST_TAIL
+
+
+def render_fault(code: str, message: str) -> bytes:
+    return b"".join((
+        _XML_DECL, _ENVELOPE_FAULT,
+        _FAULT.format(code=code, message=escape(message)).encode(),
+        _ENVELOPE_END,
+    ))
+
+
+def dispatch(service: NotesService, op: str, params: Dict[str, str]) -> Tuple[int, bytes]:
+    # те же ошибки -> те же Fault, что и в soap_app
+    if "idempotency_key" in params:
+        current().idempotency_key = params["idempotency_key"]
+    try:
+        if op == "CreateNote":
+            return 200, render_note(op, service.create(params["description"]))
+        if op == "GetNote":
+            fields = parse_soap_fields(params.get("fields"))
+            return 200, render_note(op, service.get(params["note_id"], fields), fields)
+        if op == "ListNotes":
+            fields = parse_soap_fields(params.get("fields"))
+            return 200, b"".join(render_list(service.list(fields), fields))
+        if op == "UpdateDescription":
+            return 200, render_note(op, service.update(params["note_id"], params["description"]))
+        service.delete(params["note_id"])
+        return 200, render_deleted()
+    except Exception as e:
+        return _error_response(e)
+
+
+def _error_response(error: Exception) -> Tuple[int, bytes]:
+    if isinstance(error, ValidationError):
+        return 500, render_fault("Client", str(error))
+    if isinstance(error, NoteNotFound):
+        return 500, render_fault("Client", "note not found")
+    if isinstance(error, StorageUnavailable):
+        return 500, render_fault("Server", str(error))
+    log.exception("SOAP %s failed", type(error).__name__, exc_info=error)
+    return 500, render_fault("Server", "Internal Error")
+
+
+_STATUS = {200: "200 OK", 500: "500 Internal Server Error"}
+# сколько разных адресов WSDL держать в кэше (обычно их один-два: внешний через LB и внутренний)
+WSDL_CACHE_SIZE = 16
+_XML_CONTENT_TYPE = "text/xml; charset=utf-8"
+
+
+class FastSoapWsgi:
+    def __init__(self, service: NotesService, fallback):
+        self._service = service
+        self._fallback = fallback
+        self._wsdl: "OrderedDict[str, Tuple[str, list, bytes]]" = OrderedDict()
+        self._wsdl_lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        method = environ.get("REQUEST_METHOD", "GET")
+        if method == "GET" and environ.get("QUERY_STRING", "").split("=")[0].lower() == "wsdl":
+            return self._serve_wsdl(environ, start_response)
+        if method != "POST":
+            return self._fallback(environ, start_response)
+
+        body = self._read_body(environ)
+        parsed = parse_request(body)
+        if parsed is None:
+            environ["wsgi.input"] = io.BytesIO(body)
+            environ["CONTENT_LENGTH"] = str(len(body))
+            return self._fallback(environ, start_response)
+
+        status, payload = dispatch(self._service, *parsed)
+        start_response(_STATUS[status], [("Content-Type", _XML_CONTENT_TYPE), ("Content-Length", str(len(payload)))])
+        return [payload]
+
+    def _read_body(self, environ) -> bytes:
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            length = 0
+        stream = environ["wsgi.input"]
+        return stream.read(length) if length > 0 else stream.read()
+
+    def _serve_wsdl(self, environ, start_response):
+        # WSDL зависит от адреса запроса (soap:address), поэтому кэш по URL. Адрес включает Host
+        # от клиента, так что кэш ограничен: давно не запрошенные адреса вытесняются
+        key = request_uri(environ, include_query=False)
+        with self._wsdl_lock:
+            cached = self._wsdl.get(key)
+            if cached is not None:
+                self._wsdl.move_to_end(key)
+        if cached is None:
+            captured = {}
+
+            def capture(status, headers, exc_info=None):
+                captured["status"], captured["headers"] = status, headers
+
+            body = b"".join(self._fallback(environ, capture))
+            if not captured["status"].startswith("200"):
+                start_response(captured["status"], captured["headers"])
+                return [body]
+            with self._wsdl_lock:
+                cached = self._wsdl.setdefault(key, (captured["status"], captured["headers"], body))
+                while len(self._wsdl) > WSDL_CACHE_SIZE:
+                    self._wsdl.popitem(last=False)
+
+        status, headers, body = cached
+        start_response(status, list(headers))
+        return [body]
+
+
+_LIST_CHUNK = 64
+# потоковый ListNotes держит соединение пула и серверный курсор, пока клиент читает;
+# медленный или зависший клиент дольше этого обрывается
+LIST_STREAM_MAX_SEC = float(os.getenv("SOAP_LIST_STREAM_MAX_SEC", "300"))
+# и лимит чтений при этом не занимает: одновременных потоков на процесс не больше этого,
+# чтобы медленные клиенты не выбрали пул соединений (по умолчанию 20 + 10) у остальных запросов
+LIST_STREAM_MAX = int(os.getenv("SOAP_LIST_STREAM_MAX", "8"))
+
+
+def _render_chunk(notes: Iterator, size: int, fields=None) -> bytes:
+    return b"".join(render_list_item(n, fields) for n in itertools.islice(notes, size))
+
+
+class FastSoapAsgi:
+    # ASGI-вход для /soap: быстрые операции обрабатываются без WSGI-адаптера,
+    # ListNotes пишется в сокет порциями по мере чтения из БД.
+    def __init__(self, service: NotesService, fallback, list_stream_max: int = LIST_STREAM_MAX):
+        self._service = service
+        self._fallback = fallback
+        self._list_slots = threading.BoundedSemaphore(list_stream_max)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            return await self._fallback(scope, receive, send)
+
+        body = await self._read_body(receive)
+        parsed = parse_request(body)
+        if parsed is None:
+            return await self._fallback(scope, self._replay(body, receive), send)
+
+        op, params = parsed
+        if op == "ListNotes":
+            return await self._list_notes(params.get("fields"), scope, receive, send)
+        if op == "GetNote":
+            try:
+                fields = parse_soap_fields(params.get("fields"))
+                status, payload = 200, render_note(op, await self._service.aget(params["note_id"], fields), fields)
+            except Exception as e:
+                status, payload = _error_response(e)
+            response = Response(payload, status_code=status, media_type=_XML_CONTENT_TYPE)
+        else:
+            status, payload = await run_in_threadpool(dispatch, self._service, op, params)
+            response = Response(payload, status_code=status, media_type=_XML_CONTENT_TYPE)
+        await response(scope, receive, send)
+
+    async def _read_body(self, receive) -> bytes:
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        return b"".join(chunks)
+
+    def _replay(self, body: bytes, receive):
+        sent = False
+
+        async def replay():
+            nonlocal sent
+            if sent:
+                return await receive()
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        return replay
+
+    async def _list_notes(self, raw_fields: Optional[str], scope, receive, send):
+        try:
+            fields = parse_soap_fields(raw_fields)
+        except ValidationError as e:
+            response = Response(render_fault("Client", str(e)), status_code=500, media_type=_XML_CONTENT_TYPE)
+            return await response(scope, receive, send)
+        if not self._list_slots.acquire(blocking=False):
+            # 503 + Retry-After: LB повторит на другом экземпляре, не открывая circuit breaker
+            response = Response(
+                render_fault("Server", "too many ListNotes streams"),
+                status_code=503,
+                headers={"Retry-After": "1"},
+                media_type=_XML_CONTENT_TYPE,
+            )
+            return await response(scope, receive, send)
+        try:
+            await self._stream_notes(fields, scope, receive, send)
+        finally:
+            self._list_slots.release()
+
+    async def _stream_notes(self, fields, scope, receive, send):
+        notes = self._service.iter_list(fields)
+        try:
+            # первая порция читается до отправки заголовков, чтобы ошибку БД отдать как Fault
+            try:
+                first = await run_in_threadpool(_render_chunk, notes, _LIST_CHUNK, fields)
+            except StorageUnavailable as e:
+                response = Response(render_fault("Server", str(e)), status_code=500, media_type=_XML_CONTENT_TYPE)
+            except Exception:
+                log.exception("ListNotes failed")
+                response = Response(
+                    render_fault("Server", "Internal Error"), status_code=500, media_type=_XML_CONTENT_TYPE
+                )
+            else:
+                response = StreamingResponse(_stream_list(notes, first, fields), media_type=_XML_CONTENT_TYPE)
+            with anyio.move_on_after(LIST_STREAM_MAX_SEC) as timer:
+                await response(scope, receive, send)
+            if timer.cancelled_caught:
+                log.warning("ListNotes stream aborted after %s s", LIST_STREAM_MAX_SEC)
+        finally:
+            # курсор закрываем здесь, а не в finally генератора ответа: при обрыве клиента
+            # тот может так и не выполниться, и соединение осталось бы занятым
+            with anyio.CancelScope(shield=True):
+                await run_in_threadpool(notes.close)
+
+
+async def _stream_list(notes: Iterator, first: bytes, fields=None):
+    yield _LIST_HEAD + first
+    while True:
+        chunk = await run_in_threadpool(_render_chunk, notes, _LIST_CHUNK, fields)
+        if not chunk:
+            break
+        yield chunk
+    yield _LIST_TAIL